@@ -0,0 +1,77 @@
+"""Микробенчмарк стоимости выбора обработчика на одно сообщение.
+
+Сравнивает прежнюю цепочку фильтров `lambda m: state.get(m.chat.id) == States.X`
+с таблицей маршрутов по состоянию. Оба варианта прогоняются через настоящий
+aiogram Dispatcher.feed_update; обработчики пустые, к Telegram API запросов нет.
+
+    python benchmarks/dispatch.py [число сообщений]
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime
+from enum import IntEnum
+from aiogram import Bot, Dispatcher, types
+from aiogram.filters.command import Command
+
+States = IntEnum("States", [f"STATE_{i}" for i in range(21)], start=0)
+state = {}
+
+
+async def noop(message: types.Message):
+    pass
+
+
+def build_filter_chain() -> Dispatcher:
+    dp = Dispatcher()
+    dp.message(Command("start"))(noop)
+    dp.message(Command("status"))(noop)
+    for value in States:
+        dp.message(lambda m, value=value: state.get(m.chat.id) == value)(noop)
+    return dp
+
+
+def build_router() -> Dispatcher:
+    dp = Dispatcher()
+    dp.message(Command("start"))(noop)
+    dp.message(Command("status"))(noop)
+    routes = {(value, "text"): noop for value in States}
+
+    @dp.message()
+    async def dispatch_state(message: types.Message):
+        handler = routes.get((state.get(message.chat.id), "text" if message.text is not None else None))
+        if handler is not None:
+            await handler(message)
+
+    return dp
+
+
+def make_update(update_id: int) -> types.Update:
+    return types.Update(update_id=update_id, message=types.Message(
+        message_id=update_id, date=datetime.now(), text="Назад",
+        chat=types.Chat(id=1, type="private"),
+        from_user=types.User(id=1, is_bot=False, first_name="Bench")
+    ))
+
+
+async def measure(dp: Dispatcher, bot: Bot, state_value: States, count: int) -> float:
+    state[1] = state_value
+    updates = [make_update(i) for i in range(count)]
+    start = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+async def main(count: int):
+    bot = Bot(token="123456:BENCHMARK")
+    variants = {"filter chain": build_filter_chain(), "state router": build_router()}
+    print(f"{'state':<12}" + "".join(f"{name:>16}" for name in variants) + "   (мкс на сообщение)")
+    for state_value in (States.STATE_0, States.STATE_10, States.STATE_20):
+        results = [await measure(dp, bot, state_value, count) for dp in variants.values()]
+        print(f"{state_value.name:<12}" + "".join(f"{result:>16.1f}" for result in results))
+    await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
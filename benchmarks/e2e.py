@@ -0,0 +1,211 @@
+"""Сквозной нагрузочный замер: операторы параллельно проводят выдачу и добавление GEM, Edan и Getein.
+
+Сообщения проходят через настоящий Dispatcher из handlers (feed_update), ответы
+принимает фиктивная сессия Bot, листы Google заменены листами в памяти
+(benchmarks/fake_sheets.py) с задержкой на каждый вызов. Фоновые репликация
+журнала и запись истории работают как в боте. Печатает p50/p95 времени
+обработки сообщения, пропускную способность, число вызовов Google API на операцию
+и расхождения журнала с листами после дозаписи, затем сводку метрик из metrics.py.
+Оборудование чередуется по операциям: GEM, Edan (лот и срок — кнопками в порядке FEFO,
+при добавлении через раз — анализатор), Getein (срок — кнопкой).
+
+    python benchmarks/e2e.py --operators 20 --operations 10 --latency 0.2
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+workdir = tempfile.mkdtemp(prefix="sklad-bench-")
+os.environ.update({
+    "LEDGER_PATH": os.path.join(workdir, "ledger.sqlite3"),
+    "HISTORY_SPOOL_PATH": os.path.join(workdir, "history_spool.jsonl"),
+    "OCR_CACHE_PATH": os.path.join(workdir, "ocr_cache.json"),
+    "SESSION_BACKEND": "memory",
+    "ALLOWED_TELEGRAM_IDS": ",".join(str(chat_id) for chat_id in range(1, 1001)),
+    "LEDGER_PUSH_INTERVAL": os.getenv("LEDGER_PUSH_INTERVAL", "0.5"),
+    "HISTORY_FLUSH_INTERVAL": os.getenv("HISTORY_FLUSH_INTERVAL", "1"),
+})
+
+from aiogram import Bot, methods, types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from benchmarks.fake_sheets import install  # noqa: E402
+from config import GEMS, TESTS, PURPOSES, EDAN_PRODUCTS  # noqa: E402
+import handlers  # noqa: E402
+from handlers import dp, state, States  # noqa: E402
+from ledger import ledger, replicator, EDAN_ANALYZER  # noqa: E402
+from sheets import read_all, stock_cache, edan_index, getein_index, _cell_count, ANALYZER_CELL  # noqa: E402
+from expiry import expiry_index  # noqa: E402
+from metrics import summary  # noqa: E402
+from history import history_writer  # noqa: E402
+
+
+class FakeSession(BaseSession):
+    """Сессия Bot без сети: отвечает на sendMessage и запоминает последнюю клавиатуру чата."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.keyboards = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if isinstance(method, methods.SendMessage):
+            self.keyboards[method.chat_id] = method.reply_markup
+            return types.Message(
+                message_id=self.calls, date=datetime.now(), text=method.text,
+                chat=types.Chat(id=method.chat_id, type="private")
+            )
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class Operator:
+    """Оператор в отдельном чате: отправляет шаги диалога и выбирает первую кнопку, где нужен выбор."""
+
+    def __init__(self, chat_id: int, bot: Bot, session: FakeSession, latencies: list):
+        self.chat_id = chat_id
+        self.bot = bot
+        self.session = session
+        self.latencies = latencies
+        self.update_id = chat_id * 1_000_000
+
+    def first_button(self) -> str:
+        keyboard = self.session.keyboards.get(self.chat_id)
+        return keyboard.keyboard[0][0].text
+
+    async def send(self, text: str):
+        self.update_id += 1
+        update = types.Update(update_id=self.update_id, message=types.Message(
+            message_id=self.update_id, date=datetime.now(), text=text,
+            chat=types.Chat(id=self.chat_id, type="private"),
+            from_user=types.User(id=self.chat_id, is_bot=False, first_name=f"Оператор {self.chat_id}")
+        ))
+        start = time.perf_counter()
+        await dp.feed_update(self.bot, update)
+        self.latencies.append(time.perf_counter() - start)
+
+    async def issue(self, i: int, equipment: str):
+        for text in (f"Сотрудник {self.chat_id}", "ГКБ 1", PURPOSES[0], equipment):
+            await self.send(text)
+        if equipment == "Gem":
+            await self.send(GEMS[i % len(GEMS)])
+            await self.send(TESTS[i % len(TESTS)])
+            await self.send(self.first_button())  # Срок
+        elif equipment == "Edan":
+            await self.send(EDAN_PRODUCTS[1 + i % 3])
+            await self.send(self.first_button())  # Лот
+            await self.send(self.first_button())  # Срок
+        else:
+            await self.send(f"Getein {1 + i % 5}")
+            await self.send(self.first_button())  # Срок
+        await self.send("1")
+
+    async def add(self, i: int, equipment: str):
+        await self.send(equipment)
+        if equipment == "Gem":
+            steps = (GEMS[i % len(GEMS)], TESTS[i % len(TESTS)], "01.06.2031", "2")
+        elif equipment == "Edan":
+            steps = (EDAN_ANALYZER, "1") if i % 2 else (EDAN_PRODUCTS[1 + i % 3], "L2", "01.06.2031", "2")
+        else:
+            steps = (f"Getein {1 + i % 5}", "01.06.2031", "2")
+        for text in steps:
+            await self.send(text)
+
+    async def run(self, operations: int) -> Counter:
+        """Проводит operations операций подряд; чётные операторы выдают, нечётные добавляют.
+
+        Возвращает число завершённых операций по видам оборудования.
+        """
+        issuing = self.chat_id % 2 == 0
+        await self.send("/start")
+        await self.send("Забираем картридж" if issuing else "Добавляем картридж")
+        done = Counter()
+        for i in range(operations):
+            equipment = ("Gem", "Edan", "Getein")[(i + self.chat_id) % 3]
+            await (self.issue(i, equipment) if issuing else self.add(i, equipment))
+            if state.get(self.chat_id) == States.WAITING_ANOTHER:
+                done[equipment] += 1
+            await self.send("Да")
+        return done
+
+
+def mismatches() -> list[str]:
+    """Сравнивает остатки журнала с листами, прочитанными заново после дозаписи."""
+    values = read_all()
+    stock_cache.load_rows(values["stock"])
+    edan_index.load_rows(values["edan"])
+    getein_index.load_rows(values["getein"])
+    edan = edan_index.snapshot()
+    edan[(EDAN_ANALYZER, "-", "-")] = _cell_count(values["analyzers"], ANALYZER_CELL)
+    problems = []
+    for sheet, snapshot in (("stock", stock_cache.snapshot()), ("edan", edan), ("getein", getein_index.snapshot())):
+        in_sheet = {key: qty for key, qty in snapshot.items() if qty > 0}
+        in_ledger = {tuple(key): qty for *key, qty in ledger.rows(sheet)}
+        problems += [f"{sheet} {key}: журнал {in_ledger.get(key)}, лист {in_sheet.get(key)}"
+                     for key in in_sheet.keys() | in_ledger.keys() if in_sheet.get(key) != in_ledger.get(key)]
+    return problems
+
+
+def percentile(values: list[float], q: float) -> float:
+    return statistics.quantiles(values, n=100)[int(q) - 1] if len(values) > 1 else values[0]
+
+
+async def main(args):
+    calls = install(latency=args.latency)
+    session = FakeSession()
+    bot = Bot(token="123456:BENCHMARK", session=session)
+    tasks = [asyncio.create_task(replicator.run()), asyncio.create_task(history_writer.run())]
+    while not (expiry_index.fefo("stock", (GEMS[0], TESTS[0])) and expiry_index.fefo("getein", ("Getein 1",))):  # Первая сверка
+        await asyncio.sleep(0.05)
+    calls.clear()
+
+    latencies = []
+    operators = [Operator(chat_id, bot, session, latencies) for chat_id in range(1, args.operators + 1)]
+    start = time.perf_counter()
+    by_equipment = sum(await asyncio.gather(*(operator.run(args.operations) for operator in operators)), Counter())
+    done = sum(by_equipment.values())
+    elapsed = time.perf_counter() - start
+    drain_start = time.perf_counter()
+    await replicator.close()
+    await history_writer.close()
+    drain = time.perf_counter() - drain_start
+    for task in tasks:
+        task.cancel()
+
+    google_calls = sum(calls.values())
+    print(f"операторов: {args.operators}, операций: {done} "
+          f"({', '.join(f'{name} {count}' for name, count in sorted(by_equipment.items()))}), задержка Google: {args.latency * 1000:.0f} мс")
+    print(f"сообщений: {len(latencies)}, p50: {percentile(latencies, 50) * 1000:.2f} мс, p95: {percentile(latencies, 95) * 1000:.2f} мс")
+    print(f"пропускная способность: {done / elapsed:.1f} операций/с, дозапись в таблицы после нагрузки: {drain:.2f} с")
+    print(f"вызовов Google API: {google_calls} ({google_calls / max(done, 1):.2f} на операцию), Telegram API: {session.calls}")
+    for name, count in sorted(calls.items()):
+        print(f"  {name}: {count}")
+    problems = mismatches()
+    print(f"расхождений журнала и листов: {len(problems)}")
+    for problem in problems[:10]:
+        print(f"  {problem}")
+    print(summary())
+    handlers.sessions.close()
+    ledger.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--operators", type=int, default=20)
+    parser.add_argument("--operations", type=int, default=10, help="операций на оператора")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка каждого вызова Google API, секунды")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,193 @@
+"""Листы Google Sheets в памяти для нагрузочных замеров без обращения к настоящей таблице.
+
+FakeWorksheet повторяет методы gspread.Worksheet, которые использует бот, считает
+вызовы по листам и методам и может добавлять задержку к каждому вызову
+(вызовы идут из пула потоков run_sheets, как и настоящие запросы).
+
+    from benchmarks.fake_sheets import install
+    calls = install(latency=0.2)  # до первого обращения к листам
+"""
+import threading
+import time
+from collections import Counter
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+import sheets
+from config import GEMS, TESTS, EDAN_PRODUCTS
+
+
+class FakeCell:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeWorksheet:
+    """Лист в памяти: сетка строк, счётчик вызовов и искусственная задержка."""
+
+    def __init__(self, title: str, rows: list[list] = (), latency: float = 0.0, calls: Counter = None):
+        self.title = title
+        self.latency = latency
+        self.calls = calls if calls is not None else Counter()
+        self._rows = [[str(value) for value in values] for values in rows]
+        self._lock = threading.Lock()
+        self.modified = 0
+
+    def _call(self, method: str, write: bool = False):
+        self.calls[f"{self.title}.{method}"] += 1
+        if write:
+            self.modified += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _cell(self, row: int, col: int) -> str:
+        if row <= len(self._rows) and col <= len(self._rows[row - 1]):
+            return self._rows[row - 1][col - 1]
+        return ""
+
+    def _set(self, row: int, col: int, value):
+        while len(self._rows) < row:
+            self._rows.append([])
+        values = self._rows[row - 1]
+        values.extend([""] * (col - len(values)))
+        values[col - 1] = "" if value is None else str(value)
+
+    def _read(self, range_name: str) -> list[list[str]]:
+        """Значения диапазона A1 без хвостовых пустых ячеек и строк, как их отдаёт API."""
+        first, _, last = range_name.split("!")[-1].partition(":")
+        top, left = a1_to_rowcol(first)
+        if last and last.isalpha():  # Открытый диапазон вида A2:D — до последней строки листа
+            bottom, right = max(len(self._rows), top), a1_to_rowcol(last + "1")[1]
+        else:
+            bottom, right = a1_to_rowcol(last or first)
+        rows = []
+        for row in range(top, bottom + 1):
+            values = [self._cell(row, col) for col in range(left, right + 1)]
+            while values and values[-1] == "":
+                values.pop()
+            rows.append(values)
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def _last_row(self) -> int:
+        return max((i for i, values in enumerate(self._rows, 1) if any(values)), default=0)
+
+    def get(self, range_name: str) -> list[list[str]]:
+        self._call("get")
+        with self._lock:
+            return self._read(range_name)
+
+    def batch_get(self, ranges: list[str]) -> list[list[list[str]]]:
+        self._call("batch_get")
+        with self._lock:
+            return [self._read(range_name) for range_name in ranges]
+
+    def batch_update(self, data: list[dict], value_input_option=None):
+        self._call("batch_update", write=True)
+        with self._lock:
+            for update in data:
+                top, left = a1_to_rowcol(update["range"].split("!")[-1].split(":")[0])
+                for i, values in enumerate(update["values"]):
+                    for j, value in enumerate(values):
+                        self._set(top + i, left + j, value)
+
+    def get_all_values(self) -> list[list[str]]:
+        self._call("get_all_values")
+        with self._lock:
+            rows = self._rows[:self._last_row()]
+            width = max((len(values) for values in rows), default=0)
+            return [values + [""] * (width - len(values)) for values in rows]
+
+    def col_values(self, col: int) -> list[str]:
+        self._call("col_values")
+        with self._lock:
+            values = [self._cell(row, col) for row in range(1, len(self._rows) + 1)]
+            while values and values[-1] == "":
+                values.pop()
+            return values
+
+    def cell(self, row: int, col: int) -> FakeCell:
+        self._call("cell")
+        with self._lock:
+            return FakeCell(self._cell(row, col))
+
+    def update_cell(self, row: int, col: int, value):
+        self._call("update_cell", write=True)
+        with self._lock:
+            self._set(row, col, value)
+
+    def append_rows(self, values: list[list], value_input_option=None) -> dict:
+        self._call("append_rows", write=True)
+        with self._lock:
+            first = self._last_row() + 1
+            del self._rows[first - 1:]
+            self._rows.extend([["" if value is None else str(value) for value in row] for row in values])
+            last = rowcol_to_a1(first + len(values) - 1, max((len(row) for row in values), default=1))
+        return {"updates": {"updatedRange": f"'{self.title}'!A{first}:{last}"}}
+
+    def append_row(self, values: list, value_input_option=None) -> dict:
+        return self.append_rows([values], value_input_option)
+
+    def delete_rows(self, start_index: int, end_index: int = None):
+        self._call("delete_rows", write=True)
+        with self._lock:
+            del self._rows[start_index - 1:(end_index or start_index)]
+
+
+class FakeSpreadsheet:
+    """Таблица из листов в памяти: modifiedTime по числу записей и values:batchGet по нескольким листам."""
+
+    def __init__(self, worksheets: list[FakeWorksheet], latency: float = 0.0, calls: Counter = None):
+        self.worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+        self.latency = latency
+        self.calls = calls if calls is not None else Counter()
+
+    def _call(self, method: str):
+        self.calls[f"spreadsheet.{method}"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_lastUpdateTime(self) -> str:
+        self._call("get_lastUpdateTime")
+        return str(sum(worksheet.modified for worksheet in self.worksheets.values()))
+
+    def values_batch_get(self, ranges: list[str], params=None) -> dict:
+        self._call("values_batch_get")
+        value_ranges = []
+        for range_name in ranges:
+            title, _, cells = range_name.rpartition("!")
+            worksheet = self.worksheets[title.strip("'").replace("''", "'")]
+            with worksheet._lock:
+                value_ranges.append({"range": range_name, "values": worksheet._read(cells)})
+        return {"valueRanges": value_ranges}
+
+
+def stock_rows(qty: int, expiry: str = "01.01.2030") -> list[list]:
+    """Лист склада с одной партией каждой модели GEM и количеством qty для каждого числа тестов."""
+    width = max(max(cols.values()) for cols in sheets.COL_MAP.values())
+    rows = [[""] * width for _ in range(sheets.FIRST_STOCK_ROW)]
+    for gem in GEMS:
+        cols = sheets.COL_MAP[gem]
+        rows[-1][cols["date"] - 1] = expiry
+        for test in TESTS:
+            rows[-1][cols[test] - 1] = qty
+    return rows
+
+
+def install(latency: float = 0.0, qty: int = 1000) -> Counter:
+    """Подменяет таблицу и листы модуля sheets объектами в памяти и возвращает общий счётчик вызовов."""
+    calls = Counter()
+    fakes = {
+        "stock_sheet": FakeWorksheet("Склад", stock_rows(qty), latency, calls),
+        "history_sheet": FakeWorksheet("История операций", [sheets.ARCHIVE_HEADER], latency, calls),
+        "edan_sheet": FakeWorksheet("Edan", [["Наименование", "Лот", "Срок", "Количество", "", "", 0]] + [
+            [item, "L1", "01.01.2030", qty] for item in EDAN_PRODUCTS[1:]
+        ], latency, calls),
+        "getein_sheet": FakeWorksheet("Getein", [["Наименование", "Срок", "Количество"]] + [
+            [f"Getein {i}", "01.01.2030", qty] for i in range(1, 6)
+        ], latency, calls),
+        "archive_sheet": FakeWorksheet("Архив", [sheets.ARCHIVE_HEADER], latency, calls),
+    }
+    with sheets.sheets_ctx._lock:
+        sheets.sheets_ctx._sheets.update(fakes)
+        sheets.sheets_ctx._doc = FakeSpreadsheet(list(fakes.values()), latency, calls)
+    return calls
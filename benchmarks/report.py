@@ -0,0 +1,126 @@
+"""Замер /report на многолетней истории.
+
+Заполняет лист архива в памяти (benchmarks/fake_sheets.py) синтетическими операциями
+за несколько лет, выгружает его в колоночное хранилище report.HistoryStore тем же
+HistoryExporter, что и бот, затем дописывает строки и проверяет, что повторная
+выгрузка читает только новые. Печатает время выгрузки, размер хранилища на диске,
+время загрузки с диска, время нескольких типичных отчётов и наибольшую паузу цикла
+событий, пока отчёт строится.
+
+    python benchmarks/report.py --years 5 --per-day 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+workdir = tempfile.mkdtemp(prefix="sklad-bench-")
+os.environ.update({
+    "LEDGER_PATH": os.path.join(workdir, "ledger.sqlite3"),
+    "HISTORY_SPOOL_PATH": os.path.join(workdir, "history_spool.jsonl"),
+    "HISTORY_STORE_PATH": os.path.join(workdir, "history_store"),
+})
+
+from benchmarks.fake_sheets import install  # noqa: E402
+from config import GEMS, TESTS, PURPOSES  # noqa: E402
+from sheets import sheets_ctx  # noqa: E402
+from ledger import ledger  # noqa: E402
+from report import HistoryStore, history_store, history_exporter, report  # noqa: E402
+
+HOSPITALS = [f"ГКБ {i}" for i in range(1, 41)]
+QUERIES = [
+    "",
+    "период=прошлый_квартал куда=\"ГКБ 1\" модель=5000 тесты=450",
+    "период=всё по=модель,тесты",
+    "период=год по=куда,месяц",
+    "период=всё тип=все по=тип,год",
+]
+
+
+def history_rows(years: int, per_day: int) -> list[list]:
+    """Операции выдачи и добавления за years лет до сегодняшнего дня."""
+    rng = random.Random(1)
+    today = date.today()
+    rows = []
+    for offset in range(years * 365, 0, -1):
+        day = (today - timedelta(days=offset)).strftime("%d.%m.%Y")
+        for _ in range(per_day):
+            issue = rng.random() < 0.8
+            rows.append([
+                f"Оператор {rng.randint(1, 30)}",
+                rng.choice(HOSPITALS) if issue else "На склад",
+                rng.choice(PURPOSES) if issue else "Добавление",
+                rng.choice(GEMS), rng.choice(TESTS), rng.randint(1, 5),
+                f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{today.year + 1}",
+                f"{day} {rng.randint(8, 19):02d}:{rng.randint(0, 59):02d}",
+                "Выдача" if issue else "Добавление",
+            ])
+    return rows
+
+
+async def loop_stall() -> float:
+    """Наибольшая задержка тиков по 5 мс, пока задачу не отменят: столько ждали бы другие операторы."""
+    worst = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            worst = max(worst, time.perf_counter() - started - 0.005)
+    except asyncio.CancelledError:
+        return worst
+
+
+def store_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+async def main(args):
+    calls = install()
+    rows = history_rows(args.years, args.per_day)
+    sheets_ctx.archive_sheet.append_rows(rows)
+    sheets_ctx.history_sheet.append_rows(rows[-500:])
+    calls.clear()
+
+    started = time.perf_counter()
+    await history_exporter.export()
+    print(f"Первая выгрузка {len(rows)} строк: {time.perf_counter() - started:.2f} с, "
+          f"хранилище {store_size(history_store.path) / 1024 / 1024:.1f} МБ, вызовов API: {sum(calls.values())}")
+
+    sheets_ctx.archive_sheet.append_rows(rows[:1000])
+    calls.clear()
+    started = time.perf_counter()
+    await history_exporter.export()
+    print(f"Повторная выгрузка 1000 новых строк: {(time.perf_counter() - started) * 1000:.0f} мс, "
+          f"в хранилище {len(history_store.archive)} строк архива, вызовов API: {sum(calls.values())}")
+
+    started = time.perf_counter()
+    fresh = HistoryStore(history_store.path)
+    fresh.load()
+    print(f"Загрузка с диска: {(time.perf_counter() - started) * 1000:.0f} мс")
+
+    for query in QUERIES:
+        timings, stalls = [], []
+        for _ in range(args.repeat):
+            ticker = asyncio.create_task(loop_stall())
+            started = time.perf_counter()
+            text = await report(fresh, ledger, query)
+            timings.append(time.perf_counter() - started)
+            ticker.cancel()
+            stalls.append(await ticker)
+        print(f"\n/report {query}\n  медиана {statistics.median(timings) * 1000:.0f} мс, "
+              f"наибольшая пауза цикла событий {max(stalls) * 1000:.0f} мс")
+        print("  " + "\n  ".join(text.splitlines()[:4]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--per-day", type=int, default=200, help="операций в день")
+    parser.add_argument("--repeat", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
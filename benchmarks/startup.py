@@ -0,0 +1,50 @@
+"""Замер стоимости импорта модулей бота.
+
+Считает время `import bot` в чистом процессе (отдельно от импорта самих
+aiogram и gspread, который от проекта не зависит), число сетевых соединений,
+авторизаций и открытий таблиц, сделанных во время импорта, и подгружены ли
+PIL и pytesseract. Сеть не нужна: соединения перехватываются и отклоняются.
+
+    python benchmarks/startup.py
+"""
+import os
+import socket
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+counts = {"connect": 0, "authorize": 0, "open": 0}
+
+
+def refuse_connect(sock, address):
+    counts["connect"] += 1
+    raise ConnectionRefusedError(address)
+
+
+def counting(name, func):
+    def wrapper(*args, **kwargs):
+        counts[name] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def main():
+    start = time.perf_counter()
+    import aiogram  # noqa: F401
+    import gspread
+    print(f"import aiogram, gspread: {(time.perf_counter() - start) * 1000:.0f} ms")
+    with mock.patch.object(socket.socket, "connect", refuse_connect), \
+            mock.patch.object(gspread, "authorize", counting("authorize", gspread.authorize)), \
+            mock.patch.object(gspread.Client, "open", counting("open", gspread.Client.open)):
+        start = time.perf_counter()
+        import bot  # noqa: F401
+        elapsed = time.perf_counter() - start
+    print(f"import bot: {elapsed * 1000:.0f} ms")
+    print(f"network connects: {counts['connect']}, authorize: {counts['authorize']}, open: {counts['open']}")
+    print(f"PIL loaded: {'PIL.Image' in sys.modules}, pytesseract loaded: {'pytesseract' in sys.modules}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
-from config import BOT_TOKEN
-from handlers import dp
+from config import (
+    BOT_TOKEN, METRICS_HOST, METRICS_PORT,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT
+)
+from handlers import dp, sessions
+from ledger import ledger, replicator
+from history import history_writer, history_archiver
+from expiry import expiry_alerter
+from report import history_exporter
+from ocr import ocr_pool, ocr_cache
+from metrics import start_server
 
 # Logging setup
 logging.basicConfig(
@@ -10,11 +19,60 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-async def on_startup(_):
+background_tasks = set()
+workers = (replicator, history_writer, history_archiver, expiry_alerter, history_exporter, ocr_cache)  # Фоновые циклы с run() и stop()
+metrics_runner = None
+
+def start_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def on_startup(bot: Bot):
+    global metrics_runner
     logging.info("Bot started")
-    asyncio.create_task(refresh_preloaded_data())  # Запуск фоновой задачи
+    expiry_alerter.bot = bot
+    for worker in workers:  # Запуск фоновых задач
+        start_background(worker.run())
+    if METRICS_PORT:
+        metrics_runner = await start_server(METRICS_HOST, METRICS_PORT)
+    if BOT_MODE == "webhook":
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+        logging.info(f"Webhook set to {WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH}")
+    else:
+        await bot.delete_webhook()  # Иначе getUpdates отклоняется после работы в режиме webhook
+
+async def on_shutdown():
+    # Циклы завершают текущую итерацию, затем остаток журнала отправляется один раз
+    for worker in workers:
+        worker.stop()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await replicator.close()
+    await history_writer.close()
+    ocr_pool.shutdown()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    sessions.close()
+    ledger.close()
+    logging.info("Bot stopped")
+
+def run_webhook(bot: Bot):
+    """Принимает обновления через локальный aiohttp-сервер; хуки dp запускаются вместе с приложением."""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    if not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL is required when BOT_MODE=webhook")
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
 
 if __name__ == "__main__":
     bot = Bot(token=BOT_TOKEN)
-    dp.bot = bot
-    asyncio.run(dp.start_polling(on_startup=on_startup))
\ No newline at end of file
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if BOT_MODE == "webhook":
+        run_webhook(bot)
+    else:
+        asyncio.run(dp.start_polling(bot))
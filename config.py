@@ -16,6 +16,62 @@ SCOPE = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/drive"
 ]
+STOCK_REFRESH_INTERVAL = int(os.getenv("STOCK_REFRESH_INTERVAL", 30))  # Проверка изменений таблицы (Drive modifiedTime), секунды
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", 4))  # Одновременных запросов к Google API
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", 600))  # Пересборка списков наименований, секунды
+STATUS_PAGE_SIZE = int(os.getenv("STATUS_PAGE_SIZE", 25))  # Строк остатков на странице /status
+EXPIRY_SOON_DAYS = int(os.getenv("EXPIRY_SOON_DAYS", 30))  # «Истекает скоро», дней
+EXPIRY_ALERT_INTERVAL = float(os.getenv("EXPIRY_ALERT_INTERVAL", 86400))  # Проверка сроков для уведомлений владельцу, секунды
+SHEETS_REQUESTS_PER_MINUTE = int(os.getenv("SHEETS_REQUESTS_PER_MINUTE", 60))  # Квота Sheets API на пользователя
+SHEETS_BURST = int(os.getenv("SHEETS_BURST", 10))  # Запросов подряд без ожидания
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", 6))  # Повторов при 429/5xx
+SHEETS_BACKOFF_MAX = float(os.getenv("SHEETS_BACKOFF_MAX", 64))  # Предел паузы между повторами, секунды
+
+# Локальный журнал SQLite — основной источник данных, таблицы обновляются в фоне
+LEDGER_PATH = os.getenv("LEDGER_PATH", "ledger.sqlite3")
+LEDGER_PUSH_INTERVAL = float(os.getenv("LEDGER_PUSH_INTERVAL", 2))  # Отправка изменений в таблицы, секунды
+
+# История операций: пакетная запись
+HISTORY_SPOOL_PATH = os.getenv("HISTORY_SPOOL_PATH", "history_spool.jsonl")
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", 20))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", 5))  # секунды
+ARCHIVE_THRESHOLD = int(os.getenv("ARCHIVE_THRESHOLD", 1000))  # Строк в истории до архивации
+ARCHIVE_KEEP_ROWS = int(os.getenv("ARCHIVE_KEEP_ROWS", 100))  # Последние строки остаются в истории
+ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", 200))  # Строк за один перенос
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 3600))  # секунды
+HISTORY_STORE_PATH = os.getenv("HISTORY_STORE_PATH", "history_store")  # Колоночная копия истории и архива для /report
+HISTORY_EXPORT_INTERVAL = float(os.getenv("HISTORY_EXPORT_INTERVAL", 3600))  # Выгрузка новых строк, секунды
+
+# Режим получения обновлений: "polling" или "webhook" (aiohttp-сервер за обратным прокси)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес прокси, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+
+# Метрики: локальный endpoint в формате Prometheus (0 — выключен)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+
+# Сессии диалогов
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")  # "memory" или "sqlite"
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.sqlite3")
+SESSION_MAX = int(os.getenv("SESSION_MAX", 10000))  # Сессий в памяти
+SESSION_TTL = float(os.getenv("SESSION_TTL", 86400))  # Брошенная сессия удаляется, секунды
+
+# OCR
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", os.cpu_count() or 1))  # Процессов распознавания
+OCR_QUEUE_SIZE = int(os.getenv("OCR_QUEUE_SIZE", 8))  # Фото в ожидании сверх занятых процессов
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", 30))  # Предел на одно фото, секунды
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", 1600))  # Длинная сторона фото перед распознаванием, пиксели
+OCR_THRESHOLD = os.getenv("OCR_THRESHOLD", "fixed")  # "fixed" (порог 128) или "otsu"
+OCR_ROI = tuple(float(x) for x in os.getenv("OCR_ROI", "").split(",") if x)  # Доли кадра: left,top,right,bottom
+ALBUM_COLLECT_DELAY = float(os.getenv("ALBUM_COLLECT_DELAY", 1.0))  # Ожидание остальных фото альбома, секунды
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", 512))  # Запомненных результатов распознавания
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", "ocr_cache.json")  # Пустое значение — без сохранения на диск
+OCR_CACHE_FLUSH_INTERVAL = float(os.getenv("OCR_CACHE_FLUSH_INTERVAL", 30))  # Сохранение кэша на диск, секунды
+OCR_LANGS = [lang for lang in os.getenv("OCR_LANGS", "eng,eng+rus").split(",") if lang]  # Сначала быстрый проход
 
 # Equipment types
 EQUIPMENT_TYPES = ["Gem", "Edan", "Getein"]
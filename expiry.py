@@ -0,0 +1,129 @@
+import asyncio
+import bisect
+import logging
+from datetime import date, timedelta
+from config import OWNER_ID, EXPIRY_SOON_DAYS, EXPIRY_ALERT_INTERVAL
+from ledger import Ledger, ledger
+from summary import describe, NO_EXPIRY
+from utils import parse_expiry
+
+# Длина префикса ключа, внутри которого выбирается партия: GEM — (модель, тесты), Edan и Getein — наименование
+GROUP_PREFIX = {"stock": 2, "edan": 1, "getein": 1}
+
+
+class ExpiryIndex:
+    """Индекс остатков всех трёх видов оборудования, отсортированный по сроку годности.
+
+    Обновляется по одному ключу при каждом изменении журнала. Запросы по диапазону дат
+    и порядок FEFO (первым выдаётся то, что раньше истекает) берутся из индекса без обхода листов.
+    """
+
+    def __init__(self, ledger: Ledger):
+        self._dates = []  # отсортированные (срок, лист, ключ)
+        self._groups = {}  # (лист, префикс ключа) -> отсортированные (срок, ключ)
+        self._qty = {}  # (лист, ключ) -> (срок, остаток)
+        for sheet in GROUP_PREFIX:
+            for *key, qty in ledger.rows(sheet):
+                self.update(sheet, tuple(key), qty)
+        ledger.subscribe(self.update)
+
+    @staticmethod
+    def _ordinal(sheet: str, key: tuple) -> int:
+        _, expiry, _ = describe(sheet, key, 0)
+        expiry_date = parse_expiry(expiry) if expiry else None
+        return expiry_date.toordinal() if expiry_date else NO_EXPIRY
+
+    def update(self, sheet: str, key: tuple, qty: int):
+        """Вставляет, обновляет или удаляет один ключ."""
+        if sheet not in GROUP_PREFIX:
+            return
+        group = self._groups.setdefault((sheet, key[:GROUP_PREFIX[sheet]]), [])
+        known = self._qty.pop((sheet, key), None)
+        if known is not None:
+            ordinal = known[0]
+            del self._dates[bisect.bisect_left(self._dates, (ordinal, sheet, key))]
+            del group[bisect.bisect_left(group, (ordinal, key))]
+        if qty > 0:
+            ordinal = known[0] if known is not None else self._ordinal(sheet, key)
+            self._qty[(sheet, key)] = (ordinal, qty)
+            bisect.insort(self._dates, (ordinal, sheet, key))
+            bisect.insort(group, (ordinal, key))
+
+    def fefo(self, sheet: str, prefix: tuple) -> list[tuple[tuple, int]]:
+        """Партии с ненулевым остатком внутри префикса ключа, от ближайшего срока к дальнему."""
+        return [(key, self._qty[(sheet, key)][1]) for _, key in self._groups.get((sheet, prefix), ())]
+
+    def between(self, start: date | None, end: date) -> list[tuple[date, str, tuple, int]]:
+        """Партии со сроком в диапазоне [start, end]: (срок, лист, ключ, остаток)."""
+        lo = bisect.bisect_left(self._dates, (start.toordinal(),)) if start else 0
+        hi = bisect.bisect_left(self._dates, (end.toordinal() + 1,))
+        return [
+            (date.fromordinal(ordinal), sheet, key, self._qty[(sheet, key)][1])
+            for ordinal, sheet, key in self._dates[lo:hi]
+        ]
+
+    def expiring(self, days: int) -> list[tuple[date, str, tuple, int]]:
+        """Партии, срок которых истёк или истекает в ближайшие days дней."""
+        return self.between(None, date.today() + timedelta(days=days))
+
+
+class ExpiryAlerter:
+    """Периодически сообщает владельцу о партиях, истекающих в ближайшие days дней.
+
+    О каждой партии сообщается один раз; если партия ушла со склада, напоминание снимается.
+    Список отправленных напоминаний хранится в журнале, поэтому перезапуск не повторяет их.
+    """
+
+    def __init__(self, index: ExpiryIndex, ledger: Ledger, owner_id: int, days: int, interval: float):
+        self.index = index
+        self.ledger = ledger
+        self.owner_id = owner_id
+        self.days = days
+        self.interval = interval
+        self.bot = None  # задаётся при запуске бота
+        self._stopping = asyncio.Event()
+
+    async def check(self):
+        """Отправляет владельцу список новых истекающих партий."""
+        lots = self.index.expiring(self.days)
+        current = {(sheet, key) for _, sheet, key, _ in lots}
+        known = self.ledger.alerted_expiries()
+        alerted = known & current
+        fresh = [lot for lot in lots if (lot[1], lot[2]) not in alerted]
+        if not fresh:
+            if alerted != known:
+                self.ledger.set_alerted_expiries(alerted)
+            return
+        today = date.today()
+        lines = [f"Истекают в ближайшие {self.days} дн.:"]
+        for expiry_date, sheet, key, qty in fresh:
+            section, _, line = describe(sheet, key, qty)
+            mark = " (истёк)" if expiry_date < today else ""
+            lines.append(f"  - {section}: {line}{mark}")
+        text = "\n".join(lines)
+        for start in range(0, len(text), 4000):
+            await self.bot.send_message(self.owner_id, text[start:start + 4000])
+        self.ledger.set_alerted_expiries(alerted | {(sheet, key) for _, sheet, key, _ in fresh})
+        logging.info(f"Expiry alert sent for {len(fresh)} lots")
+
+    async def run(self):
+        """Проверяет сроки раз в interval секунд до вызова stop()."""
+        if not self.owner_id or self.bot is None:
+            return
+        while not self._stopping.is_set():
+            try:
+                await self.check()
+            except Exception as e:
+                logging.error(f"Error sending expiry alert: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        """Просит run() завершиться."""
+        self._stopping.set()
+
+
+expiry_index = ExpiryIndex(ledger)
+expiry_alerter = ExpiryAlerter(expiry_index, ledger, OWNER_ID, EXPIRY_SOON_DAYS, EXPIRY_ALERT_INTERVAL)
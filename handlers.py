@@ -1,13 +1,28 @@
+import asyncio
 import logging
 from aiogram import Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters.command import Command
-from config import ALLOWED_TELEGRAM_IDS, ALLOWED_PHONE_NUMBERS, OWNER_ID
+from config import (
+    ALLOWED_TELEGRAM_IDS, ALLOWED_PHONE_NUMBERS, OWNER_ID, GEMS, TESTS, ALBUM_COLLECT_DELAY,
+    SESSION_BACKEND, SESSION_DB_PATH, SESSION_MAX, SESSION_TTL
+)
 from keyboards import (
     get_action_kb, get_purpose_kb, get_gem_kb, get_test_kb, get_yes_no_kb,
-    get_equipment_kb, get_edan_product_kb
+    get_equipment_kb, get_edan_product_kb, get_getein_item_kb, get_status_kb, get_lot_kb
 )
-from sheets import update_stock, history_sheet, archive_history, preloaded_data, edan_sheet, getein_sheet
-from utils import log_time, extract_gem_info, process_image
+from sheets import edan_catalog, getein_catalog
+from ledger import ledger, StockConflictError
+from summary import stock_summary
+from expiry import expiry_index
+from report import REPORT_HELP, history_store, report
+from history import history_writer
+from storage import create_session_store, StateView, DataView
+from importer import IMPORT_HELP, read_text, read_document, parse_rows
+from ocr import ocr_pool, recognize_photo, OcrBusyError
+from utils import log_time
+from metrics import summary, gauge
+from collections import Counter
 from enum import IntEnum
 from datetime import datetime
 
@@ -33,9 +48,46 @@ class States(IntEnum):
     WAITING_GETEIN_ITEM = 15
     WAITING_GETEIN_EXPIRY = 16
     WAITING_GETEIN_QUANTITY = 17
+    WAITING_ALBUM_CONFIRM = 18
+    WAITING_IMPORT = 19
+    WAITING_IMPORT_CONFIRM = 20
+
+sessions = create_session_store(SESSION_BACKEND, SESSION_DB_PATH, SESSION_MAX, SESSION_TTL)
+state = StateView(sessions, States)
+data = DataView(sessions)
+album_buffers = {}  # media_group_id -> сообщения альбома, ожидающие обработки
+gauge("bot_album_buffers", "Альбомов, ожидающих сбора", lambda: len(album_buffers))
+routes = {}  # (состояние, вид сообщения) -> обработчик
+
+def message_kind(message: types.Message) -> str | None:
+    """Определяет вид сообщения для таблицы маршрутов."""
+    if message.photo:
+        return "photo"
+    if message.document:
+        return "document"
+    if message.text is not None:
+        return "text"
+    return None
 
-state = {}
-data = {}
+def route(state_value: States, kind: str = "text"):
+    """Регистрирует обработчик состояния: выбор обработчика — один поиск в словаре вместо цепочки фильтров."""
+    def decorator(handler):
+        routes[(state_value, kind)] = handler
+        return handler
+    return decorator
+
+def record_operation(stock=(), edan=(), getein=(), history=()):
+    """Фиксирует операцию в локальном журнале; таблицы обновляются фоновой репликацией."""
+    ledger.commit(stock=stock, edan=edan, getein=getein, history=history)
+    history_writer.notify()
+
+@dp.message.outer_middleware()
+async def persist_session(handler, event: types.Message, middleware_data: dict):
+    """Сохраняет сессию чата после обработки каждого сообщения."""
+    try:
+        return await handler(event, middleware_data)
+    finally:
+        sessions.save(event.chat.id)
 
 # Обработчик команды /start
 @dp.message(Command("start"))
@@ -43,7 +95,7 @@ data = {}
 async def start_command(message: types.Message):
     """Запускает бота и проверяет авторизацию."""
     data[message.chat.id] = {}
-    await archive_history()
+    ocr_pool.cancel(message.chat.id)
     if message.from_user.id in ALLOWED_TELEGRAM_IDS:
         data[message.chat.id]["user"] = message.from_user.full_name
         state[message.chat.id] = States.WAITING_ACTION
@@ -57,7 +109,7 @@ async def start_command(message: types.Message):
 @dp.message(Command("status"))
 @log_time
 async def status_command(message: types.Message):
-    """Показывает текущие остатки Gem-картриджей."""
+    """Показывает первую страницу остатков GEM, Edan и Getein из готовой сводки."""
     if message.from_user.id not in ALLOWED_TELEGRAM_IDS:
         await message.reply("Нет доступа. Поделитесь контактом.", reply_markup=types.ReplyKeyboardMarkup(
             keyboard=[[types.KeyboardButton(text="Поделиться контактом", request_contact=True)]],
@@ -65,20 +117,145 @@ async def status_command(message: types.Message):
         ))
         return
     try:
-        status_msg = "Текущие остатки Gem-картриджей:\n"
-        for gem in ["3500", "4000", "5000"]:
-            status_msg += f"\nGEM {gem}:\n"
-            dates = preloaded_data.get(gem, {}).get("date", [])
-            for test in ["150", "300", "450", "600"]:
-                quantities = preloaded_data.get(gem, {}).get(test, [])
-                for date, qty in zip(dates, quantities):
-                    if date and qty and int(qty) > 0:
-                        status_msg += f"  - {test} тестов, срок {date}: {qty} шт.\n"
-        await message.reply(status_msg or "Склад пуст.")
+        text, page, pages = stock_summary.page("all", 0)
+        await message.reply(text, reply_markup=get_status_kb("all", page, pages))
     except Exception as e:
         logging.error(f"Error fetching status: {e}")
         await message.reply("Ошибка при получении остатков.")
 
+@dp.callback_query(F.data.startswith("status:"))
+@log_time
+async def status_page(callback: types.CallbackQuery):
+    """Листает /status и переключает фильтры, редактируя то же сообщение."""
+    if callback.from_user.id not in ALLOWED_TELEGRAM_IDS:
+        await callback.answer("Нет доступа.")
+        return
+    _, filter_code, page = callback.data.split(":")
+    text, page, pages = stock_summary.page(filter_code, int(page))
+    try:
+        await callback.message.edit_text(text, reply_markup=get_status_kb(filter_code, page, pages))
+    except TelegramBadRequest:
+        pass  # Та же страница: сообщение не изменилось
+    await callback.answer()
+
+@dp.message(Command("metrics"))
+@log_time
+async def metrics_command(message: types.Message):
+    """Показывает владельцу сводку метрик: время обработчиков и запросов, очереди, кэши."""
+    if message.from_user.id != OWNER_ID:
+        await message.reply("Команда доступна только владельцу.")
+        return
+    await message.reply(summary()[:4000])
+
+@dp.message(Command("report"))
+@log_time
+async def report_command(message: types.Message):
+    """Сводка расхода по истории и архиву из локального колоночного хранилища."""
+    if message.from_user.id not in ALLOWED_TELEGRAM_IDS:
+        await message.reply("Нет доступа.")
+        return
+    try:
+        text = await report(history_store, ledger, message.text.partition(" ")[2])
+    except ValueError as e:
+        await message.reply(f"{e}\n\n{REPORT_HELP}")
+        return
+    except Exception as e:
+        logging.error(f"Error building report: {e}")
+        await message.reply("Ошибка при построении отчёта.")
+        return
+    await message.reply(text[:4000])
+
+@dp.message(Command("import"))
+@log_time
+async def import_command(message: types.Message):
+    """Запускает массовое добавление поставки из текста или файла CSV/XLSX."""
+    if message.from_user.id not in ALLOWED_TELEGRAM_IDS:
+        await message.reply("Нет доступа. Поделитесь контактом.")
+        return
+    data[message.chat.id] = {"user": message.from_user.full_name, "operation": "add"}
+    if message.document:  # Файл с подписью /import — сразу к сводке
+        rows = await read_import_file(message)
+        if rows is None:
+            state[message.chat.id] = States.WAITING_IMPORT
+            return
+        await preview_import(message, rows)
+        return
+    _, _, text = (message.text or "").partition("\n")
+    if text.strip():
+        await preview_import(message, read_text(text))
+        return
+    state[message.chat.id] = States.WAITING_IMPORT
+    await message.reply(IMPORT_HELP, reply_markup=types.ReplyKeyboardRemove())
+
+async def read_import_file(message: types.Message) -> list[list[str]] | None:
+    """Скачивает и разбирает приложенный CSV/XLSX; если файл не читается, отвечает и возвращает None."""
+    file = await message.bot.get_file(message.document.file_id)
+    content = (await message.bot.download_file(file.file_path)).read()
+    try:
+        return read_document(message.document.file_name or "", content)
+    except Exception as e:
+        logging.error(f"Error reading import file: {e}")
+        await message.reply(f"Не удалось прочитать файл: {e}")
+        return None
+
+async def preview_import(message: types.Message, rows: list[list[str]]):
+    """Проверяет строки поставки и показывает сводку для подтверждения."""
+    changes, errors = parse_rows(rows, edan_catalog.items())
+    total = sum(len(lines) for lines in changes.values())
+    if not total:
+        state[message.chat.id] = States.WAITING_IMPORT
+        await message.reply("Нет корректных строк.\n" + "\n".join(errors[:20]))
+        return
+    data[message.chat.id]["import"] = changes
+    state[message.chat.id] = States.WAITING_IMPORT_CONFIRM
+    summary = f"Строк к добавлению: {total} (Gem: {len(changes['Gem'])}, Edan: {len(changes['Edan'])}, Getein: {len(changes['Getein'])})."
+    if errors:
+        summary += f"\nПропущено строк: {len(errors)}\n" + "\n".join(errors[:20])
+    await message.reply(summary + "\nДобавить на склад?", reply_markup=get_yes_no_kb())
+
+# Обработчик строк поставки
+@route(States.WAITING_IMPORT)
+@route(States.WAITING_IMPORT, "document")
+@log_time
+async def handle_import(message: types.Message):
+    """Принимает строки поставки текстом или документом."""
+    if message.document:
+        rows = await read_import_file(message)
+        if rows is None:
+            return
+    elif message.text and message.text.lower() == "назад":
+        state[message.chat.id] = States.WAITING_ACTION
+        await message.reply("Выберите действие:", reply_markup=get_action_kb())
+        return
+    else:
+        rows = read_text(message.text or "")
+    await preview_import(message, rows)
+
+# Обработчик подтверждения поставки
+@route(States.WAITING_IMPORT_CONFIRM)
+@log_time
+async def handle_import_confirm(message: types.Message):
+    """Записывает поставку и её историю одной транзакцией журнала."""
+    changes = data[message.chat.id].pop("import", {})
+    if message.text != "Да":
+        state[message.chat.id] = States.WAITING_IMPORT
+        await message.reply("Отправьте исправленные строки или «Назад».")
+        return
+    user = data[message.chat.id]["user"]
+    timestamp = datetime.now().strftime("%d.%m.%Y %H:%M")
+    record_operation(
+        stock=changes["Gem"], edan=changes["Edan"], getein=changes["Getein"],
+        history=[[user, "На склад", "Добавление", gem, tests, qty, expiry, timestamp, "Добавление"]
+                 for gem, tests, expiry, qty in changes["Gem"]] +
+                [[user, "На склад", "Добавление Edan", item, "-", qty, expiry, timestamp, "Добавление"]
+                 for item, lot, expiry, qty in changes["Edan"]] +
+                [[user, "На склад", "Добавление Getein", item, "-", qty, expiry, timestamp, "Добавление"]
+                 for item, expiry, qty in changes["Getein"]]
+    )
+    await message.reply(f"Поставка добавлена: {sum(len(lines) for lines in changes.values())} строк.")
+    state[message.chat.id] = States.WAITING_ANOTHER
+    await message.reply("Ещё одна операция?", reply_markup=get_yes_no_kb())
+
 # Обработчик контакта для авторизации
 @dp.message(F.content_type == "contact")
 @log_time
@@ -94,7 +271,7 @@ async def contact_handler(message: types.Message):
         await message.reply("Доступ запрещён.")
 
 # Обработчик выбора действия
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_ACTION)
+@route(States.WAITING_ACTION)
 @log_time
 async def handle_action(message: types.Message):
     """Обрабатывает выбор действия: выдача или добавление."""
@@ -118,7 +295,7 @@ async def handle_action(message: types.Message):
         await message.reply("Выберите действие:", reply_markup=get_action_kb())
 
 # Обработчик "Кто забирает"
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_ISSUER)
+@route(States.WAITING_ISSUER)
 @log_time
 async def handle_issuer(message: types.Message):
     """Сохраняет имя того, кто забирает картридж."""
@@ -131,7 +308,7 @@ async def handle_issuer(message: types.Message):
     await message.reply("Введите название больницы:")
 
 # Обработчик ввода больницы
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_HOSPITAL)
+@route(States.WAITING_HOSPITAL)
 @log_time
 async def handle_hospital(message: types.Message):
     """Сохраняет название больницы и переходит к выбору цели."""
@@ -144,7 +321,7 @@ async def handle_hospital(message: types.Message):
     await message.reply("Зачем забираем?", reply_markup=get_purpose_kb())
 
 # Обработчик выбора цели
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_PURPOSE)
+@route(States.WAITING_PURPOSE)
 @log_time
 async def handle_purpose(message: types.Message):
     """Сохраняет цель операции и переходит к выбору оборудования."""
@@ -161,7 +338,7 @@ async def handle_purpose(message: types.Message):
         await message.reply("Выберите из списка.", reply_markup=get_purpose_kb())
 
 # Обработчик выбора типа оборудования
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_EQUIPMENT_TYPE)
+@route(States.WAITING_EQUIPMENT_TYPE)
 @log_time
 async def handle_equipment_type(message: types.Message):
     """Обрабатывает выбор типа оборудования для выдачи."""
@@ -174,23 +351,15 @@ async def handle_equipment_type(message: types.Message):
         await message.reply("Для какого GEM?", reply_markup=get_gem_kb())
     elif message.text == "Edan":
         state[message.chat.id] = States.WAITING_EDAN_PRODUCT
-        await message.reply("Выберите наименование для выдачи:", reply_markup=get_edan_product_kb())
+        await message.reply("Выберите наименование для выдачи:", reply_markup=get_edan_product_kb(edan_catalog.items()))
     elif message.text == "Getein":
-        if getein_sheet:
-            items = sorted(set(getein_sheet.col_values(1)[1:]))
-            item_kb = types.ReplyKeyboardMarkup(
-                resize_keyboard=True, one_time_keyboard=True,
-                keyboard=[[types.KeyboardButton(text=item)] for item in items] + [[types.KeyboardButton(text="Назад")]]
-            )
-            state[message.chat.id] = States.WAITING_GETEIN_ITEM
-            await message.reply("Какое наименование Getein забираем?", reply_markup=item_kb)
-        else:
-            await message.reply("Ошибка: таблица Getein недоступна.")
+        state[message.chat.id] = States.WAITING_GETEIN_ITEM
+        await message.reply("Какое наименование Getein забираем?", reply_markup=get_getein_item_kb(getein_catalog.items()))
     else:
         await message.reply("Выберите из списка.", reply_markup=get_equipment_kb())
 
 # Обработчик выбора GEM
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_GEM)
+@route(States.WAITING_GEM)
 @log_time
 async def handle_gem(message: types.Message):
     """Сохраняет модель GEM и переходит к выбору тестов."""
@@ -210,15 +379,29 @@ async def handle_gem(message: types.Message):
         await message.reply("Выберите из списка.", reply_markup=get_gem_kb())
 
 # Обработчик фото для OCR (только при добавлении GEM)
-@dp.message(F.photo & (lambda m: state.get(m.chat.id) == States.WAITING_TESTS) & (lambda m: data.get(m.chat.id, {}).get("operation") == "add"))
+@route(States.WAITING_TESTS, "photo")
 @log_time
 async def handle_photo(message: types.Message):
     """Обрабатывает фото картриджа с помощью OCR."""
+    if data.get(message.chat.id, {}).get("operation") != "add":
+        await message.reply("Выберите из списка.", reply_markup=get_test_kb())
+        return
+    if message.media_group_id:
+        await collect_album(message)
+        return
     photo = message.photo[-1]  # Берем самое большое изображение
-    file = await message.bot.get_file(photo.file_id)
-    image_bytes = await message.bot.download_file(file.file_path)
-    ocr_text = await process_image(image_bytes.read())
-    gem, expiry, tests = extract_gem_info(ocr_text)
+    try:
+        result = await recognize_photo(message.bot, photo, message.chat.id)
+    except OcrBusyError:
+        await message.reply("Распознавание фото сейчас перегружено. Введите данные вручную.\nСколько тестов?", reply_markup=get_test_kb())
+        return
+    except Exception as e:
+        logging.error(f"Error recognizing photo: {e!r}")
+        await message.reply("Не удалось обработать фото. Введите данные вручную.\nСколько тестов?", reply_markup=get_test_kb())
+        return
+    if result is None or state.get(message.chat.id) != States.WAITING_TESTS:
+        return  # Пользователь уже продолжил без фото
+    gem, expiry, tests = result
 
     # Проверка распознанных данных
     from config import GEMS, TESTS
@@ -247,12 +430,80 @@ async def handle_photo(message: types.Message):
         reply_markup=types.ReplyKeyboardRemove()
     )
 
+async def collect_album(message: types.Message):
+    """Собирает фото одного альбома и обрабатывает их вместе после короткой паузы."""
+    buffer = album_buffers.get(message.media_group_id)
+    if buffer is not None:
+        buffer.append(message)
+        return
+    album_buffers[message.media_group_id] = [message]
+    await asyncio.sleep(ALBUM_COLLECT_DELAY)
+    await handle_album(album_buffers.pop(message.media_group_id))
+
+async def handle_album(messages: list[types.Message]):
+    """Распознаёт все фото альбома параллельно и показывает сводку для подтверждения."""
+    message = messages[0]
+    chat_id = message.chat.id
+    ocr_pool.cancel(chat_id)
+    results = await asyncio.gather(
+        *(recognize_photo(m.bot, m.photo[-1], chat_id, replace=False, wait=True) for m in messages),
+        return_exceptions=True
+    )
+    if state.get(chat_id) != States.WAITING_TESTS:
+        return  # Пользователь уже продолжил без фото
+    groups = Counter()
+    failed = 0
+    for result in results:
+        if isinstance(result, BaseException):
+            logging.error(f"Error recognizing album photo: {result!r}")
+            failed += 1
+        elif result is None or result[0] not in GEMS or result[2] not in TESTS or not result[1]:
+            failed += 1
+        else:
+            gem, expiry, tests = result
+            groups[(gem, tests, expiry)] += 1
+    if not groups:
+        await message.reply(
+            "Не удалось распознать ни одно фото альбома.\nПожалуйста, введите данные вручную.\nСколько тестов?",
+            reply_markup=get_test_kb()
+        )
+        return
+    data[chat_id]["album"] = [[gem, tests, expiry, qty] for (gem, tests, expiry), qty in groups.items()]
+    state[chat_id] = States.WAITING_ALBUM_CONFIRM
+    summary = "\n".join(f"  - GEM {gem}, {tests} тестов, срок {expiry}: {qty} шт." for (gem, tests, expiry), qty in groups.items())
+    await message.reply(
+        f"Распознано фото: {sum(groups.values())} из {len(messages)}.\n{summary}\n" +
+        (f"Не распознано: {failed} (добавьте их вручную).\n" if failed else "") +
+        "Добавить на склад?",
+        reply_markup=get_yes_no_kb()
+    )
+
+# Обработчик подтверждения добавления альбома
+@route(States.WAITING_ALBUM_CONFIRM)
+@log_time
+async def handle_album_confirm(message: types.Message):
+    """Добавляет все распознанные картриджи альбома одной записью в склад и историю."""
+    album = data[message.chat.id].pop("album", [])
+    if message.text != "Да":
+        state[message.chat.id] = States.WAITING_TESTS
+        await message.reply("Сколько тестов? (или отправьте фото картриджа)", reply_markup=get_test_kb())
+        return
+    timestamp = datetime.now().strftime("%d.%m.%Y %H:%M")
+    record_operation(stock=[(gem, tests, expiry, qty) for gem, tests, expiry, qty in album], history=[
+        [data[message.chat.id]["user"], "На склад", "Добавление", gem, tests, qty, expiry, timestamp, "Добавление"]
+        for gem, tests, expiry, qty in album
+    ])
+    await message.reply(f"Добавлено {sum(qty for *_, qty in album)} картриджей GEM.")
+    state[message.chat.id] = States.WAITING_ANOTHER
+    await message.reply("Ещё одна операция?", reply_markup=get_yes_no_kb())
+
 # Обработчик выбора количества тестов
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_TESTS)
+@route(States.WAITING_TESTS)
 @log_time
 async def handle_tests(message: types.Message):
     """Сохраняет количество тестов и предлагает выбрать срок годности."""
     from config import TESTS
+    ocr_pool.cancel(message.chat.id)
     if message.text.lower() == "назад":
         state[message.chat.id] = States.WAITING_GEM
         await message.reply("Для какого GEM?", reply_markup=get_gem_kb())
@@ -261,28 +512,20 @@ async def handle_tests(message: types.Message):
         data[message.chat.id]["tests"] = message.text
         gem = data[message.chat.id]["gem"]
         test = message.text
-        dates = preloaded_data.get(gem, {}).get("date", [])
-        quantities = preloaded_data.get(gem, {}).get(test, [])
-        expiry_kb = []
-        for date, qty in zip(dates, quantities):
-            try:
-                if date and int(qty or 0) > 0:
-                    expiry_kb.append([types.KeyboardButton(text=f"{date} ({qty} шт.)")])
-            except ValueError:
-                continue
+        expiry_kb = [[types.KeyboardButton(text=f"{key[2]} ({qty} шт.)")] for key, qty in expiry_index.fefo("stock", (gem, test))]
         if not expiry_kb and data[message.chat.id].get("operation") == "issue":
             await message.reply("Нет доступных картриджей с таким количеством тестов.", reply_markup=get_test_kb())
             return
         expiry_kb.append([types.KeyboardButton(text="Ввести вручную" if data[message.chat.id].get("operation") == "add" else "Назад")])
         state[message.chat.id] = States.WAITING_EXPIRY
-        await message.reply("Выберите срок годности:" if data[message.chat.id].get("operation") == "issue" else "Выберите или введите срок годности:", reply_markup=types.ReplyKeyboardMarkup(
+        await message.reply("Выберите срок годности (первым — ближайший):" if data[message.chat.id].get("operation") == "issue" else "Выберите или введите срок годности:", reply_markup=types.ReplyKeyboardMarkup(
             resize_keyboard=True, one_time_keyboard=True, keyboard=expiry_kb
         ))
     else:
         await message.reply("Выберите из списка.", reply_markup=get_test_kb())
 
 # Обработчик выбора срока годности
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_EXPIRY)
+@route(States.WAITING_EXPIRY)
 @log_time
 async def handle_expiry(message: types.Message):
     """Сохраняет срок годности и запрашивает количество."""
@@ -317,7 +560,7 @@ async def handle_expiry(message: types.Message):
         await message.reply("Выберите корректный срок или введите в формате дд.мм.гггг.")
 
 # Обработчик ввода количества (выдача/добавление)
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_QUANTITY)
+@route(States.WAITING_QUANTITY)
 @log_time
 async def handle_quantity(message: types.Message):
     """Обрабатывает количество для выдачи или добавления GEM."""
@@ -336,18 +579,22 @@ async def handle_quantity(message: types.Message):
     if operation == "issue" and qty > data[message.chat.id]["available_qty"]:
         await message.reply(f"Недостаточно картриджей. Доступно: {data[message.chat.id]['available_qty']}.")
         return
-    update_stock(gem, tests, expiry, -qty if operation == "issue" else qty)
-    history_sheet.append_row([
-        data[message.chat.id].get("issuer", data[message.chat.id]["user"]),
-        data[message.chat.id].get("hospital", "На склад" if operation == "add" else ""),
-        data[message.chat.id].get("purpose", "Добавление" if operation == "add" else ""),
-        gem,
-        tests,
-        qty,
-        expiry,
-        datetime.now().strftime("%d.%m.%Y %H:%M"),
-        "Выдача" if operation == "issue" else "Добавление"
-    ])
+    try:
+        record_operation(stock=[(gem, tests, expiry, -qty if operation == "issue" else qty)], history=[[
+            data[message.chat.id].get("issuer", data[message.chat.id]["user"]),
+            data[message.chat.id].get("hospital", "На склад" if operation == "add" else ""),
+            data[message.chat.id].get("purpose", "Добавление" if operation == "add" else ""),
+            gem,
+            tests,
+            qty,
+            expiry,
+            datetime.now().strftime("%d.%m.%Y %H:%M"),
+            "Выдача" if operation == "issue" else "Добавление"
+        ]])
+    except StockConflictError as e:
+        data[message.chat.id]["available_qty"] = e.available
+        await message.reply(f"Недостаточно картриджей: остаток изменился. Доступно: {e.available}.")
+        return
     await message.reply(
         f"{'Выдано' if operation == 'issue' else 'Добавлено'} {qty} картриджей GEM {gem} {tests} тестов, срок {expiry}."
     )
@@ -355,7 +602,7 @@ async def handle_quantity(message: types.Message):
     await message.reply("Ещё одна операция?", reply_markup=get_yes_no_kb())
 
 # Обработчик выбора типа добавления
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_ADD_TYPE)
+@route(States.WAITING_ADD_TYPE)
 @log_time
 async def handle_add_type(message: types.Message):
     """Обрабатывает выбор типа оборудования для добавления."""
@@ -368,23 +615,15 @@ async def handle_add_type(message: types.Message):
         await message.reply("Для какого GEM?", reply_markup=get_gem_kb())
     elif message.text == "Edan":
         state[message.chat.id] = States.WAITING_EDAN_PRODUCT
-        await message.reply("Выберите наименование для добавления:", reply_markup=get_edan_product_kb())
+        await message.reply("Выберите наименование для добавления:", reply_markup=get_edan_product_kb(edan_catalog.items()))
     elif message.text == "Getein":
-        if getein_sheet:
-            items = sorted(set(getein_sheet.col_values(1)[1:]))
-            item_kb = types.ReplyKeyboardMarkup(
-                resize_keyboard=True, one_time_keyboard=True,
-                keyboard=[[types.KeyboardButton(text=item)] for item in items] + [[types.KeyboardButton(text="Новое(введите вручную)"), types.KeyboardButton(text="Назад")]]
-            )
-            state[message.chat.id] = States.WAITING_GETEIN_ITEM
-            await message.reply("Выберите наименование для добавления:", reply_markup=item_kb)
-        else:
-            await message.reply("Ошибка: таблица Getein недоступна.")
+        state[message.chat.id] = States.WAITING_GETEIN_ITEM
+        await message.reply("Выберите наименование для добавления:", reply_markup=get_getein_item_kb(getein_catalog.items(), with_new=True))
     else:
         await message.reply("Выберите из списка.")
 
 # Обработчик выбора продукта Edan
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_EDAN_PRODUCT)
+@route(States.WAITING_EDAN_PRODUCT)
 @log_time
 async def handle_edan_product(message: types.Message):
     """Сохраняет продукт Edan и запрашивает лот."""
@@ -393,7 +632,7 @@ async def handle_edan_product(message: types.Message):
         state[message.chat.id] = States.WAITING_ADD_TYPE if data[message.chat.id]["operation"] == "add" else States.WAITING_EQUIPMENT_TYPE
         await message.reply("Выберите тип добавления:" if data[message.chat.id]["operation"] == "add" else "Забираем для какого оборудования?", reply_markup=get_equipment_kb())
         return
-    if message.text in EDAN_PRODUCTS or message.text == "Новое(введите вручную)":
+    if message.text in EDAN_PRODUCTS or message.text in edan_catalog.items():
         data[message.chat.id]["edan_item"] = message.text if message.text != "Новое(введите вручную)" else None
         if message.text == "Анализатор Edan" and data[message.chat.id]["operation"] == "add":
             data[message.chat.id]["edan_lot"] = "-"
@@ -402,18 +641,22 @@ async def handle_edan_product(message: types.Message):
             await message.reply("Сколько штук добавить?")
         else:
             state[message.chat.id] = States.WAITING_EDAN_LOT
-            await message.reply("Введите лот/серийный номер:" if data[message.chat.id]["operation"] == "add" else "Выберите лот:", reply_markup=types.ReplyKeyboardRemove())
+            if data[message.chat.id]["operation"] == "issue" and data[message.chat.id]["edan_item"]:
+                lots = list(dict.fromkeys(key[1] for key, _ in expiry_index.fefo("edan", (message.text,))))
+                await message.reply("Выберите лот (первым — с ближайшим сроком):", reply_markup=get_lot_kb(lots))
+            else:
+                await message.reply("Введите лот/серийный номер:" if data[message.chat.id]["operation"] == "add" else "Выберите лот:", reply_markup=types.ReplyKeyboardRemove())
     else:
-        await message.reply("Выберите из списка.", reply_markup=get_edan_product_kb())
+        await message.reply("Выберите из списка.", reply_markup=get_edan_product_kb(edan_catalog.items()))
 
 # Обработчик ввода лота Edan
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_EDAN_LOT)
+@route(States.WAITING_EDAN_LOT)
 @log_time
 async def handle_edan_lot(message: types.Message):
     """Сохраняет лот Edan и запрашивает срок годности."""
     if message.text.lower() == "назад":
         state[message.chat.id] = States.WAITING_EDAN_PRODUCT
-        await message.reply("Выберите наименование:", reply_markup=get_edan_product_kb())
+        await message.reply("Выберите наименование:", reply_markup=get_edan_product_kb(edan_catalog.items()))
         return
     if not data[message.chat.id].get("edan_item"):
         data[message.chat.id]["edan_item"] = message.text
@@ -421,10 +664,15 @@ async def handle_edan_lot(message: types.Message):
         return
     data[message.chat.id]["edan_lot"] = message.text
     state[message.chat.id] = States.WAITING_EDAN_EXPIRY
-    await message.reply("Введите срок годности (дд.мм.гггг):" if data[message.chat.id]["operation"] == "add" else "Выберите срок годности:")
+    if data[message.chat.id]["operation"] == "add":
+        await message.reply("Введите срок годности (дд.мм.гггг):", reply_markup=types.ReplyKeyboardRemove())
+        return
+    item = data[message.chat.id]["edan_item"]
+    expiries = [key[2] for key, _ in expiry_index.fefo("edan", (item,)) if key[1] == message.text]
+    await message.reply("Выберите срок годности:", reply_markup=get_lot_kb(expiries))
 
 # Обработчик ввода срока годности Edan
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_EDAN_EXPIRY)
+@route(States.WAITING_EDAN_EXPIRY)
 @log_time
 async def handle_edan_expiry(message: types.Message):
     """Сохраняет срок годности Edan и запрашивает количество."""
@@ -441,7 +689,7 @@ async def handle_edan_expiry(message: types.Message):
     await message.reply("Сколько штук " + ("выдать?" if data[message.chat.id]["operation"] == "issue" else "добавить?"))
 
 # Обработчик ввода количества Edan
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_EDAN_QUANTITY)
+@route(States.WAITING_EDAN_QUANTITY)
 @log_time
 async def handle_edan_quantity(message: types.Message):
     """Обрабатывает количество для выдачи или добавления Edan."""
@@ -457,33 +705,21 @@ async def handle_edan_quantity(message: types.Message):
     item = data[message.chat.id]["edan_item"]
     lot = data[message.chat.id]["edan_lot"]
     expiry = data[message.chat.id]["edan_expiry"]
-    if item == "Анализатор Edan":
-        current_qty = int(edan_sheet.cell(2, 7).value or 0)
-        new_qty = current_qty - qty if operation == "issue" else current_qty + qty
-        edan_sheet.update_cell(2, 7, new_qty)
-    else:
-        all_data = edan_sheet.get_all_values()[1:]
-        found = False
-        for i, row in enumerate(all_data, 2):
-            if row[0] == item and row[1] == lot and row[2] == expiry:
-                current_qty = int(row[3] or 0)
-                new_qty = current_qty - qty if operation == "issue" else current_qty + qty
-                edan_sheet.update_cell(i, 4, new_qty)
-                found = True
-                break
-        if not found and operation == "add":
-            edan_sheet.append_row([item, lot, expiry, qty])
-    history_sheet.append_row([
-        data[message.chat.id].get("issuer", data[message.chat.id]["user"]),
-        data[message.chat.id].get("hospital", "На склад" if operation == "add" else ""),
-        data[message.chat.id].get("purpose", "Добавление Edan" if operation == "add" else ""),
-        item,
-        "-",
-        qty,
-        expiry,
-        datetime.now().strftime("%d.%m.%Y %H:%M"),
-        "Выдача" if operation == "issue" else "Добавление"
-    ])
+    try:
+        record_operation(edan=[(item, lot, expiry, -qty if operation == "issue" else qty)], history=[[
+            data[message.chat.id].get("issuer", data[message.chat.id]["user"]),
+            data[message.chat.id].get("hospital", "На склад" if operation == "add" else ""),
+            data[message.chat.id].get("purpose", "Добавление Edan" if operation == "add" else ""),
+            item,
+            "-",
+            qty,
+            expiry,
+            datetime.now().strftime("%d.%m.%Y %H:%M"),
+            "Выдача" if operation == "issue" else "Добавление"
+        ]])
+    except StockConflictError as e:
+        await message.reply(f"Недостаточно Edan {item} (лот {lot}, срок {expiry}). Доступно: {e.available} шт.")
+        return
     await message.reply(
         f"{'Выдано' if operation == 'issue' else 'Добавлено'} {qty} шт. Edan {item}, срок {expiry}."
     )
@@ -491,7 +727,7 @@ async def handle_edan_quantity(message: types.Message):
     await message.reply("Ещё одна операция?", reply_markup=get_yes_no_kb())
 
 # Обработчик выбора наименования Getein
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_GETEIN_ITEM)
+@route(States.WAITING_GETEIN_ITEM)
 @log_time
 async def handle_getein_item(message: types.Message):
     """Сохраняет наименование Getein и запрашивает срок годности."""
@@ -501,17 +737,23 @@ async def handle_getein_item(message: types.Message):
         return
     data[message.chat.id]["getein_item"] = message.text if message.text != "Новое(введите вручную)" else None
     state[message.chat.id] = States.WAITING_GETEIN_EXPIRY
+    if data[message.chat.id]["operation"] == "issue" and data[message.chat.id]["getein_item"]:
+        expiries = [key[1] for key, _ in expiry_index.fefo("getein", (message.text,))]
+        await message.reply("Выберите срок годности (первым — ближайший):", reply_markup=get_lot_kb(expiries))
+        return
     await message.reply("Введите наименование вручную:" if not data[message.chat.id]["getein_item"] else "Введите срок годности (дд.мм.гггг):")
 
 # Обработчик ввода срока годности Getein
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_GETEIN_EXPIRY)
+@route(States.WAITING_GETEIN_EXPIRY)
 @log_time
 async def handle_getein_expiry(message: types.Message):
     """Сохраняет срок годности Getein и запрашивает количество."""
     import re
     if message.text.lower() == "назад":
         state[message.chat.id] = States.WAITING_GETEIN_ITEM
-        await message.reply("Выберите наименование:", reply_markup=get_edan_product_kb())  # Заменить на Getein KB
+        await message.reply("Выберите наименование:", reply_markup=get_getein_item_kb(
+            getein_catalog.items(), with_new=data[message.chat.id]["operation"] == "add"
+        ))
         return
     if not data[message.chat.id].get("getein_item"):
         data[message.chat.id]["getein_item"] = message.text
@@ -525,7 +767,7 @@ async def handle_getein_expiry(message: types.Message):
     await message.reply("Сколько штук " + ("выдать?" if data[message.chat.id]["operation"] == "issue" else "добавить?"))
 
 # Обработчик ввода количества Getein
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_GETEIN_QUANTITY)
+@route(States.WAITING_GETEIN_QUANTITY)
 @log_time
 async def handle_getein_quantity(message: types.Message):
     """Обрабатывает количество для выдачи или добавления Getein."""
@@ -540,28 +782,21 @@ async def handle_getein_quantity(message: types.Message):
     operation = data[message.chat.id]["operation"]
     item = data[message.chat.id]["getein_item"]
     expiry = data[message.chat.id]["getein_expiry"]
-    all_data = getein_sheet.get_all_values()[1:]
-    found = False
-    for i, row in enumerate(all_data, 2):
-        if row[0] == item and row[1] == expiry:
-            current_qty = int(row[2] or 0)
-            new_qty = current_qty - qty if operation == "issue" else current_qty + qty
-            getein_sheet.update_cell(i, 3, new_qty)
-            found = True
-            break
-    if not found and operation == "add":
-        getein_sheet.append_row([item, expiry, qty])
-    history_sheet.append_row([
-        data[message.chat.id].get("issuer", data[message.chat.id]["user"]),
-        data[message.chat.id].get("hospital", "На склад" if operation == "add" else ""),
-        data[message.chat.id].get("purpose", "Добавление Getein" if operation == "add" else ""),
-        item,
-        "-",
-        qty,
-        expiry,
-        datetime.now().strftime("%d.%m.%Y %H:%M"),
-        "Выдача" if operation == "issue" else "Добавление"
-    ])
+    try:
+        record_operation(getein=[(item, expiry, -qty if operation == "issue" else qty)], history=[[
+            data[message.chat.id].get("issuer", data[message.chat.id]["user"]),
+            data[message.chat.id].get("hospital", "На склад" if operation == "add" else ""),
+            data[message.chat.id].get("purpose", "Добавление Getein" if operation == "add" else ""),
+            item,
+            "-",
+            qty,
+            expiry,
+            datetime.now().strftime("%d.%m.%Y %H:%M"),
+            "Выдача" if operation == "issue" else "Добавление"
+        ]])
+    except StockConflictError as e:
+        await message.reply(f"Недостаточно Getein {item} (срок {expiry}). Доступно: {e.available} шт.")
+        return
     await message.reply(
         f"{'Выдано' if operation == 'issue' else 'Добавлено'} {qty} шт. Getein {item}, срок {expiry}."
     )
@@ -569,7 +804,7 @@ async def handle_getein_quantity(message: types.Message):
     await message.reply("Ещё одна операция?", reply_markup=get_yes_no_kb())
 
 # Обработчик продолжения операций
-@dp.message(lambda m: state.get(m.chat.id) == States.WAITING_ANOTHER)
+@route(States.WAITING_ANOTHER)
 @log_time
 async def handle_another(message: types.Message):
     """Предлагает продолжить или завершить сессию."""
@@ -586,4 +821,12 @@ async def handle_another(message: types.Message):
         data.pop(message.chat.id, None)
         await message.reply("Сессия завершена. /start для перезапуска.", reply_markup=types.ReplyKeyboardRemove())
     else:
-        await message.reply("Выберите 'Да' или 'Нет'.", reply_markup=get_yes_no_kb())
\ No newline at end of file
+        await message.reply("Выберите 'Да' или 'Нет'.", reply_markup=get_yes_no_kb())
+
+# Единая точка входа для сообщений в диалоге; регистрируется после команд и контакта
+@dp.message()
+async def dispatch_state(message: types.Message):
+    """Передаёт сообщение обработчику текущего состояния чата."""
+    handler = routes.get((state.get(message.chat.id), message_kind(message)))
+    if handler is not None:
+        await handler(message)
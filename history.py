@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from config import (
+    HISTORY_SPOOL_PATH, HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL,
+    ARCHIVE_THRESHOLD, ARCHIVE_KEEP_ROWS, ARCHIVE_CHUNK_SIZE, ARCHIVE_INTERVAL
+)
+from sheets import sheets_ctx, run_sheets
+from ledger import Ledger, ledger
+
+
+class HistoryWriter:
+    """Фоновая отправка истории операций из локального журнала пакетным append_rows."""
+
+    def __init__(self, ledger: Ledger, spool_path: str, batch_size: int, flush_interval: float):
+        self.ledger = ledger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flushed = 0
+        self._full = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._migrate_spool(spool_path)
+        if self.pending:
+            logging.info(f"{self.pending} history rows are waiting to be sent")
+
+    def _migrate_spool(self, spool_path: str):
+        """Переносит строки из файла-журнала прежних версий в журнал SQLite."""
+        if not os.path.exists(spool_path):
+            return
+        rows = []
+        with open(spool_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.error(f"Skipping corrupted history spool line: {line!r}")
+        self.ledger.commit(history=rows)
+        os.remove(spool_path)
+        logging.info(f"Migrated {len(rows)} history rows from spool to ledger")
+
+    @property
+    def pending(self) -> int:
+        return self.ledger.unsynced_history_count()
+
+    def notify(self):
+        """Сообщает о новых строках в журнале; полный пакет отправляется без ожидания таймера."""
+        if self.pending >= self.batch_size:
+            self._full.set()
+
+    async def flush(self):
+        """Отправляет неотправленные строки пакетами по одному вызову append_rows."""
+        async with self._lock:
+            while True:
+                batch = self.ledger.unsynced_history(max(self.batch_size, 500))
+                if not batch:
+                    return
+                ids = [row_id for row_id, _ in batch]
+                rows = [row for _, row in batch]
+                try:
+                    await run_sheets(lambda: sheets_ctx.history_sheet.append_rows(rows))
+                except Exception as e:
+                    logging.error(f"Error flushing {len(rows)} history rows: {e}")
+                    return
+                self.ledger.mark_history_synced(ids)
+                self.flushed += len(rows)
+
+    @asynccontextmanager
+    async def paused(self):
+        """Приостанавливает отправку на время блока: лист истории не дописывается, пока его читают или переносят."""
+        async with self._lock:
+            yield
+
+    async def run(self):
+        """Сбрасывает журнал по размеру пакета или по таймеру до вызова stop()."""
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def stop(self):
+        """Просит run() завершиться после текущей отправки."""
+        self._stopping.set()
+        self._full.set()
+
+    async def close(self):
+        """Дописывает остаток журнала при остановке бота."""
+        await self.flush()
+
+
+class HistoryArchiver:
+    """Фоновый перенос старых строк истории в архив порциями ограниченного размера."""
+
+    def __init__(self, writer: HistoryWriter, threshold: int, keep_rows: int, chunk_size: int, interval: float):
+        self.writer = writer
+        self.threshold = threshold
+        self.keep_rows = keep_rows
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self._row_count = None
+        self._flushed_seen = 0
+        self._stopping = asyncio.Event()
+
+    @property
+    def row_count(self) -> int | None:
+        """Оценка числа строк листа истории (с заголовком) по собственному счётчику."""
+        if self._row_count is None:
+            return None
+        return self._row_count + self.writer.flushed - self._flushed_seen
+
+    async def _sync_row_count(self):
+        """Пересчитывает строки по одному столбцу вместо загрузки всего листа."""
+        self._flushed_seen = self.writer.flushed
+        self._row_count = len(await run_sheets(lambda: sheets_ctx.history_sheet.col_values(1), coalesce_key="history.col_values"))
+
+    def _move_chunk(self, count: int):
+        rows = sheets_ctx.history_sheet.get(f"A2:I{count + 1}")
+        if rows:
+            sheets_ctx.archive_sheet.append_rows(rows)
+        sheets_ctx.history_sheet.delete_rows(2, count + 1)
+
+    async def archive(self):
+        """Переносит в архив всё, кроме последних keep_rows строк, если лист вырос сверх порога."""
+        if self.row_count is None or self.row_count > self.threshold:
+            await self._sync_row_count()
+        if self.row_count <= self.threshold:
+            return
+        while self.row_count - 1 > self.keep_rows and not self._stopping.is_set():
+            count = min(self.chunk_size, self.row_count - 1 - self.keep_rows)
+            async with self.writer.paused():
+                await run_sheets(self._move_chunk, count)
+            self._row_count -= count
+            logging.info(f"Archived {count} history rows")
+
+    async def run(self):
+        """Периодически проверяет размер истории вне обработчиков сообщений до вызова stop()."""
+        while not self._stopping.is_set():
+            try:
+                await self.archive()
+            except Exception as e:
+                logging.error(f"Error archiving history: {e}")
+                self._row_count = None
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        """Просит run() завершиться после текущего переноса."""
+        self._stopping.set()
+
+
+history_writer = HistoryWriter(ledger, HISTORY_SPOOL_PATH, HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL)
+history_archiver = HistoryArchiver(history_writer, ARCHIVE_THRESHOLD, ARCHIVE_KEEP_ROWS, ARCHIVE_CHUNK_SIZE, ARCHIVE_INTERVAL)
@@ -0,0 +1,94 @@
+import csv
+import io
+import re
+from datetime import datetime
+from config import GEMS, TESTS, EDAN_PRODUCTS
+
+DATE_RE = re.compile(r"^\d{2}\.\d{2}\.\d{4}$")
+IMPORT_HELP = (
+    "Отправьте строки поставки текстом или файлом CSV/XLSX, по одной позиции в строке:\n"
+    "Gem;5000;450;31.12.2026;10\n"
+    "Edan;BG-10;LOT123;31.12.2026;5\n"
+    "Getein;Наименование;31.12.2026;3"
+)
+
+
+def read_text(text: str) -> list[list[str]]:
+    """Разбирает текст поставки; разделитель — точка с запятой, запятая или табуляция."""
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+    delimiter = max(";,\t", key=lines[0].count)
+    return [[cell.strip() for cell in row] for row in csv.reader(lines, delimiter=delimiter)]
+
+
+def read_document(file_name: str, content: bytes) -> list[list[str]]:
+    """Читает строки поставки из CSV или XLSX файла."""
+    if file_name.lower().endswith(".xlsx"):
+        try:
+            import openpyxl
+        except ImportError:
+            raise ValueError("Для XLSX нужен пакет openpyxl, отправьте CSV.")
+        workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+        rows = []
+        for values in workbook.active.iter_rows(values_only=True):
+            row = []
+            for value in values:
+                if value is None:
+                    value = ""
+                elif hasattr(value, "strftime"):
+                    value = value.strftime("%d.%m.%Y")
+                elif isinstance(value, float) and value.is_integer():
+                    value = int(value)
+                row.append(str(value).strip())
+            if any(row):
+                rows.append(row)
+        return rows
+    return read_text(content.decode("utf-8-sig"))
+
+
+def parse_rows(rows: list[list[str]], edan_items: tuple = ()) -> tuple[dict, list[str]]:
+    """Проверяет строки поставки и группирует их по листам.
+
+    Возвращает {"Gem": [(gem, тесты, срок, кол-во)], "Edan": [(наименование, лот, срок, кол-во)],
+    "Getein": [(наименование, срок, кол-во)]} и список ошибок с номерами строк.
+    """
+    changes = {"Gem": [], "Edan": [], "Getein": []}
+    errors = []
+    edan_allowed = (set(EDAN_PRODUCTS) | set(edan_items)) - {"Новое(введите вручную)"}
+    for line_no, row in enumerate(rows, 1):
+        kind = row[0].capitalize() if row else ""
+        if line_no == 1 and kind not in changes:
+            continue  # Строка заголовка
+        expected = {"Gem": 5, "Edan": 5, "Getein": 4}.get(kind)
+        if expected is None:
+            errors.append(f"Строка {line_no}: неизвестный тип «{row[0] if row else ''}».")
+            continue
+        if len(row) < expected:
+            errors.append(f"Строка {line_no}: ожидается {expected} полей.")
+            continue
+        *fields, expiry, qty = row[1:expected]
+        if not DATE_RE.match(expiry):
+            errors.append(f"Строка {line_no}: срок «{expiry}» не в формате дд.мм.гггг.")
+            continue
+        try:
+            datetime.strptime(expiry, "%d.%m.%Y")
+        except ValueError:
+            errors.append(f"Строка {line_no}: несуществующая дата «{expiry}».")
+            continue
+        if not qty.isdigit() or int(qty) == 0:
+            errors.append(f"Строка {line_no}: некорректное количество «{qty}».")
+            continue
+        if kind == "Gem":
+            gem, tests = fields
+            if gem not in GEMS or tests not in TESTS:
+                errors.append(f"Строка {line_no}: неизвестная модель GEM {gem} или тесты {tests}.")
+                continue
+        elif not fields[0].strip():
+            errors.append(f"Строка {line_no}: пустое наименование {kind}.")
+            continue
+        elif kind == "Edan" and fields[0] not in edan_allowed:
+            errors.append(f"Строка {line_no}: неизвестное наименование Edan «{fields[0]}».")
+            continue
+        changes[kind].append((*fields, expiry, int(qty)))
+    return changes, errors
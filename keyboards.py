@@ -1,5 +1,9 @@
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from functools import lru_cache
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from config import GEMS, TESTS, PURPOSES, EDAN_PRODUCTS, EQUIPMENT_TYPES
+from metrics import register_lru
+
+NEW_ITEM = "Новое(введите вручную)"
 
 def get_purpose_kb() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
@@ -19,10 +23,27 @@ def get_test_kb() -> ReplyKeyboardMarkup:
         keyboard=[[KeyboardButton(text=test)] for test in TESTS] + [[KeyboardButton(text="Назад")]]
     )
 
-def get_edan_product_kb() -> ReplyKeyboardMarkup:
+@lru_cache(maxsize=16)
+def get_edan_product_kb(extra_items: tuple[str, ...] = ()) -> ReplyKeyboardMarkup:
+    products = [p for p in EDAN_PRODUCTS if p != NEW_ITEM] + list(extra_items) + [NEW_ITEM]
     return ReplyKeyboardMarkup(
         resize_keyboard=True, one_time_keyboard=True,
-        keyboard=[[KeyboardButton(text=product)] for product in EDAN_PRODUCTS] + [[KeyboardButton(text="Назад")]]
+        keyboard=[[KeyboardButton(text=product)] for product in products] + [[KeyboardButton(text="Назад")]]
+    )
+
+@lru_cache(maxsize=16)
+def get_getein_item_kb(items: tuple[str, ...], with_new: bool = False) -> ReplyKeyboardMarkup:
+    last_row = [KeyboardButton(text=NEW_ITEM), KeyboardButton(text="Назад")] if with_new else [KeyboardButton(text="Назад")]
+    return ReplyKeyboardMarkup(
+        resize_keyboard=True, one_time_keyboard=True,
+        keyboard=[[KeyboardButton(text=item)] for item in items] + [last_row]
+    )
+
+def get_lot_kb(options: list[str]) -> ReplyKeyboardMarkup:
+    """Партии в порядке FEFO: первой идёт та, что раньше истекает."""
+    return ReplyKeyboardMarkup(
+        resize_keyboard=True, one_time_keyboard=True,
+        keyboard=[[KeyboardButton(text=option)] for option in options] + [[KeyboardButton(text="Назад")]]
     )
 
 def get_equipment_kb() -> ReplyKeyboardMarkup:
@@ -41,4 +62,24 @@ def get_action_kb() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         resize_keyboard=True, one_time_keyboard=True,
         keyboard=[[KeyboardButton(text="Забираем картридж"), KeyboardButton(text="Добавляем картридж")]]
-    )
\ No newline at end of file
+    )
+
+STATUS_FILTERS = [("all", "Все"), *((f"gem{gem}", f"GEM {gem}") for gem in GEMS), ("edan", "Edan"), ("getein", "Getein"), ("soon", "Истекают")]
+
+@lru_cache(maxsize=256)
+def get_status_kb(filter_code: str, page: int, pages: int) -> InlineKeyboardMarkup:
+    """Навигация по страницам /status и фильтры; callback_data — status:фильтр:страница."""
+    navigation = [
+        InlineKeyboardButton(text="◀", callback_data=f"status:{filter_code}:{page - 1}"),
+        InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=f"status:{filter_code}:{page}"),
+        InlineKeyboardButton(text="▶", callback_data=f"status:{filter_code}:{page + 1}"),
+    ]
+    filters = [
+        InlineKeyboardButton(text=("• " if code == filter_code else "") + title, callback_data=f"status:{code}:0")
+        for code, title in STATUS_FILTERS
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[navigation, filters[:4], filters[4:]])
+
+register_lru("edan_product_kb", get_edan_product_kb)
+register_lru("getein_item_kb", get_getein_item_kb)
+register_lru("status_kb", get_status_kb)
@@ -0,0 +1,306 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from config import LEDGER_PATH, LEDGER_PUSH_INTERVAL, STOCK_REFRESH_INTERVAL
+from metrics import gauge
+from sheets import (
+    run_sheets, stock_cache, edan_index, getein_index, format_expiry, last_modified, read_all, COL_MAP,
+    ANALYZER_CELL, _cell_count, apply_stock_changes, apply_edan_changes, apply_getein_changes
+)
+
+EDAN_ANALYZER = "Анализатор Edan"
+
+# Таблица журнала -> столбцы ключа
+TABLES = {
+    "stock": ("gem", "test", "expiry"),
+    "edan": ("item", "lot", "expiry"),
+    "getein": ("item", "expiry"),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stock (gem TEXT, test TEXT, expiry TEXT, qty INTEGER NOT NULL, PRIMARY KEY (gem, test, expiry));
+CREATE TABLE IF NOT EXISTS edan (item TEXT, lot TEXT, expiry TEXT, qty INTEGER NOT NULL, PRIMARY KEY (item, lot, expiry));
+CREATE TABLE IF NOT EXISTS getein (item TEXT, expiry TEXT, qty INTEGER NOT NULL, PRIMARY KEY (item, expiry));
+CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT NOT NULL, synced INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS history_unsynced ON history (synced, id);
+CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, sheet TEXT NOT NULL, key TEXT NOT NULL, qty_change INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS expiry_alerts (sheet TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (sheet, key));
+"""
+
+
+class StockConflictError(Exception):
+    """Остатка не хватает для выдачи: его изменили после того, как оператор увидел количество."""
+
+    def __init__(self, sheet: str, key: tuple, available: int):
+        super().__init__(f"Not enough stock in {sheet} for {key}: {available} available")
+        self.sheet = sheet
+        self.key = key
+        self.available = available
+
+
+class Ledger:
+    """Локальный журнал SQLite — основной источник остатков и истории; Google Sheets получает изменения в фоне."""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._listeners = []
+
+    def subscribe(self, callback):
+        """Регистрирует callback(лист, ключ, остаток), вызываемый после каждого изменения остатка."""
+        self._listeners.append(callback)
+
+    def _notify(self, changed: set[tuple[str, tuple]]):
+        if not self._listeners:
+            return
+        for sheet, key in changed:
+            qty = self.available(sheet, key)
+            for callback in self._listeners:
+                callback(sheet, key, qty)
+
+    def rows(self, sheet: str) -> list[tuple]:
+        """Все ключи листа с ненулевым остатком: (*ключ, остаток)."""
+        return self._db.execute(f"SELECT {', '.join(TABLES[sheet])}, qty FROM {sheet} WHERE qty > 0").fetchall()
+
+    @staticmethod
+    def _normalize(sheet: str, key: tuple) -> tuple:
+        if sheet == "stock":
+            gem, test, expiry = key
+            return gem, test, format_expiry(expiry)
+        if sheet == "edan" and key[0] == EDAN_ANALYZER:
+            return EDAN_ANALYZER, "-", "-"  # Количество анализаторов хранится в одной ячейке
+        return tuple(key)
+
+    def commit(self, stock=(), edan=(), getein=(), history=()):
+        """Фиксирует операцию одной транзакцией: остатки, изменения для репликации и строки истории.
+
+        Изменения передаются как (*ключ, изменение количества), ключи — как в TABLES. Списание — сравнение
+        с заменой: остаток уменьшается, только если его хватает, иначе вся операция откатывается
+        с StockConflictError, и одновременная выдача того же лота не уводит остаток в минус.
+        """
+        changed = set()
+        with self._db:
+            for sheet, changes in (("stock", stock), ("edan", edan), ("getein", getein)):
+                cols = TABLES[sheet]
+                where = " AND ".join(f"{col} = ?" for col in cols)
+                for *key, qty_change in changes:
+                    key = self._normalize(sheet, key)
+                    changed.add((sheet, key))
+                    if qty_change < 0:
+                        updated = self._db.execute(
+                            f"UPDATE {sheet} SET qty = qty + ? WHERE {where} AND qty >= ?", (qty_change, *key, -qty_change)
+                        ).rowcount
+                        if not updated:
+                            raise StockConflictError(sheet, key, self.available(sheet, key))
+                    else:
+                        self._db.execute(
+                            f"INSERT INTO {sheet} ({', '.join(cols)}, qty) VALUES ({', '.join('?' * len(cols))}, ?) "
+                            f"ON CONFLICT DO UPDATE SET qty = qty + excluded.qty",
+                            (*key, qty_change)
+                        )
+                    self._db.execute(
+                        "INSERT INTO outbox (sheet, key, qty_change) VALUES (?, ?, ?)",
+                        (sheet, json.dumps(key, ensure_ascii=False), qty_change)
+                    )
+            self._db.executemany(
+                "INSERT INTO history (row) VALUES (?)", [(json.dumps(row, ensure_ascii=False),) for row in history]
+            )
+        self._notify(changed)
+
+    def available(self, sheet: str, key: tuple) -> int:
+        """Текущий остаток по ключу (0, если ключа нет)."""
+        key = self._normalize(sheet, key)
+        where = " AND ".join(f"{col} = ?" for col in TABLES[sheet])
+        row = self._db.execute(f"SELECT qty FROM {sheet} WHERE {where}", key).fetchone()
+        return row[0] if row else 0
+
+    def pending_changes(self) -> dict[str, dict[tuple, tuple[list[int], int]]]:
+        """Неотправленные изменения: лист -> {ключ: (id записей, суммарное изменение)}."""
+        pending = {}
+        for change_id, sheet, key, qty_change in self._db.execute("SELECT id, sheet, key, qty_change FROM outbox ORDER BY id"):
+            key = tuple(json.loads(key))
+            ids, total = pending.setdefault(sheet, {}).get(key, ([], 0))
+            ids.append(change_id)
+            pending[sheet][key] = (ids, total + qty_change)
+        return pending
+
+    def pending_count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def ack_changes(self, ids: list[int]):
+        with self._db:
+            self._db.executemany("DELETE FROM outbox WHERE id = ?", [(change_id,) for change_id in ids])
+
+    def reconcile(self, sheet: str, snapshot: dict[tuple, int], scope=None):
+        """Принимает значения из таблицы (ручные правки) для ключей без неотправленных изменений.
+
+        scope ограничивает сверку ключами с указанными значениями первого столбца (например, моделями GEM).
+        """
+        cols = TABLES[sheet]
+        pending = {tuple(json.loads(key)) for (key,) in self._db.execute("SELECT key FROM outbox WHERE sheet = ?", (sheet,))}
+        existing = {tuple(row[:-1]): row[-1] for row in self._db.execute(f"SELECT {', '.join(cols)}, qty FROM {sheet}")}
+        if scope is not None:
+            snapshot = {key: qty for key, qty in snapshot.items() if key[0] in scope}
+            existing = {key: qty for key, qty in existing.items() if key[0] in scope}
+        where = " AND ".join(f"{col} = ?" for col in cols)
+        changed = set()
+        with self._db:
+            for key, qty in snapshot.items():
+                if key in pending or existing.get(key) == qty:
+                    continue
+                self._db.execute(
+                    f"INSERT INTO {sheet} ({', '.join(cols)}, qty) VALUES ({', '.join('?' * len(cols))}, ?) "
+                    f"ON CONFLICT DO UPDATE SET qty = excluded.qty",
+                    (*key, qty)
+                )
+                changed.add((sheet, key))
+            for key in existing.keys() - snapshot.keys() - pending:
+                self._db.execute(f"DELETE FROM {sheet} WHERE {where}", key)
+                changed.add((sheet, key))
+        self._notify(changed)
+
+    def unsynced_history(self, limit: int) -> list[tuple[int, list]]:
+        rows = self._db.execute("SELECT id, row FROM history WHERE synced = 0 ORDER BY id LIMIT ?", (limit,))
+        return [(row_id, json.loads(row)) for row_id, row in rows]
+
+    def unsynced_history_count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM history WHERE synced = 0").fetchone()[0]
+
+    def mark_history_synced(self, ids: list[int]):
+        with self._db:
+            self._db.executemany("UPDATE history SET synced = 1 WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def first_unsynced_history_id(self) -> int:
+        """Id первой неотправленной строки истории; строки с меньшим id уже есть в таблице."""
+        row_id = self._db.execute("SELECT MIN(id) FROM history WHERE synced = 0").fetchone()[0]
+        if row_id is None:
+            row_id = self._db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM history").fetchone()[0]
+        return row_id
+
+    def history_since(self, row_id: int) -> list[tuple[int, list]]:
+        """Строки истории (id, строка) начиная с row_id, отправленные и нет."""
+        rows = self._db.execute("SELECT id, row FROM history WHERE id >= ? ORDER BY id", (row_id,))
+        return [(history_id, json.loads(row)) for history_id, row in rows]
+
+    def alerted_expiries(self) -> set[tuple[str, tuple]]:
+        """Партии (лист, ключ), о сроке которых владельцу уже сообщено."""
+        return {(sheet, tuple(json.loads(key))) for sheet, key in self._db.execute("SELECT sheet, key FROM expiry_alerts")}
+
+    def set_alerted_expiries(self, alerted: set[tuple[str, tuple]]):
+        """Заменяет список партий, о которых уже сообщено."""
+        with self._db:
+            self._db.execute("DELETE FROM expiry_alerts")
+            self._db.executemany(
+                "INSERT INTO expiry_alerts (sheet, key) VALUES (?, ?)",
+                [(sheet, json.dumps(key, ensure_ascii=False)) for sheet, key in alerted]
+            )
+
+    def close(self):
+        self._db.close()
+
+
+class Replicator:
+    """Фоновая репликация журнала: пакетная отправка изменений в таблицы и приём ручных правок."""
+
+    APPLY = {"stock": apply_stock_changes, "edan": apply_edan_changes, "getein": apply_getein_changes}
+
+    def __init__(self, ledger: Ledger, push_interval: float, pull_interval: float):
+        self.ledger = ledger
+        self.push_interval = push_interval
+        self.pull_interval = pull_interval
+        self._lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        self._modified = None  # modifiedTime таблицы при последнем чтении
+        self._parts = {}  # часть листа -> значения при последнем чтении
+
+    async def push(self):
+        """Отправляет накопленные изменения: по одному пакету на лист.
+
+        Из очереди удаляются только ключи, которые дошли до таблицы; если пакет записан частично,
+        следующая отправка повторит лишь остаток, а не уже применённые изменения.
+        """
+        async with self._lock:
+            for sheet, deltas in self.ledger.pending_changes().items():
+                changes = [(*key, qty_change) for key, (_, qty_change) in deltas.items() if qty_change]
+                applied = [key for key, (_, qty_change) in deltas.items() if not qty_change]
+                try:
+                    if changes:
+                        await run_sheets(self.APPLY[sheet], changes, applied)
+                except Exception as e:
+                    logging.error(f"Error replicating {len(changes)} {sheet} changes: {e}")
+                self.ledger.ack_changes([change_id for key in set(applied) for change_id in deltas[key][0]])
+
+    @staticmethod
+    def _split(values: dict[str, list]) -> dict[str, list]:
+        """Делит прочитанное на части, которые сверяются независимо: блок каждой модели GEM и листы Edan, Getein."""
+        parts = {}
+        for gem, cols in COL_MAP.items():
+            first, last = cols["date"] - 1, max(cols.values())
+            parts[gem] = [values_row[first:last] for values_row in values["stock"]]
+        parts["edan"] = [values["edan"], values["analyzers"]]
+        parts["getein"] = values["getein"]
+        return parts
+
+    async def pull(self):
+        """Принимает в журнал ручные правки, если таблица изменилась с прошлого чтения.
+
+        Сначала проверяется modifiedTime (Drive API). Если он изменился, всё читается одним
+        values:batchGet. Разбираются и сверяются только изменившиеся блоки GEM и листы.
+        """
+        async with self._lock:
+            modified = await run_sheets(last_modified, coalesce_key="last_modified")
+            if modified == self._modified:
+                return
+            values = await run_sheets(read_all, coalesce_key="read_all")
+            parts = self._split(values)
+            changed = {name for name, value in parts.items() if self._parts.get(name) != value}
+            gems = [gem for gem in COL_MAP if gem in changed]
+            if gems:
+                stock_cache.load_rows(values["stock"], gems)
+                self.ledger.reconcile("stock", stock_cache.snapshot(), scope=gems)
+            if "edan" in changed:
+                rows, analyzers = parts["edan"]
+                edan_index.load_rows(rows)
+                edan = edan_index.snapshot()
+                edan[(EDAN_ANALYZER, "-", "-")] = _cell_count(analyzers, ANALYZER_CELL)
+                self.ledger.reconcile("edan", edan)
+            if "getein" in changed:
+                getein_index.load_rows(parts["getein"])
+                self.ledger.reconcile("getein", getein_index.snapshot())
+            self._modified = modified
+            self._parts = parts
+            logging.info(f"Sheets changed, reconciled: {', '.join(sorted(changed)) or 'nothing'}")
+
+    async def run(self):
+        """Отправляет изменения каждые push_interval секунд и сверяется с таблицами каждые pull_interval до вызова stop()."""
+        last_pull = 0.0
+        while not self._stopping.is_set():
+            try:
+                await self.push()
+                if time.monotonic() - last_pull >= self.pull_interval:
+                    await self.pull()
+                    last_pull = time.monotonic()
+            except Exception as e:
+                logging.error(f"Error in ledger replication: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.push_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        """Просит run() завершиться после текущей отправки или сверки."""
+        self._stopping.set()
+
+    async def close(self):
+        """Отправляет оставшиеся изменения при остановке бота."""
+        await self.push()
+
+
+ledger = Ledger(LEDGER_PATH)
+replicator = Replicator(ledger, LEDGER_PUSH_INTERVAL, STOCK_REFRESH_INTERVAL)
+gauge("bot_ledger_outbox_depth", "Изменений остатков, ещё не отправленных в таблицы", ledger.pending_count)
+gauge("bot_history_queue_depth", "Строк истории, ещё не отправленных в таблицу", ledger.unsynced_history_count)
@@ -0,0 +1,221 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    """Монотонный счётчик событий."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_labels(self.label_names, key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """Текущее значение; func вычисляет его в момент выгрузки (глубина очереди, размер кэша)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, func=None, labels: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.func = func
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def current(self) -> dict[tuple, float]:
+        if self.func is None:
+            with self._lock:
+                return dict(self._values)
+        try:
+            value = self.func()
+        except Exception as e:
+            logging.error(f"Error reading metric {self.name}: {e}")
+            return {}
+        return value if isinstance(value, dict) else {(): value}
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_labels(self.label_names, key)} {value}" for key, value in sorted(self.current().items())]
+
+
+class Histogram(Metric):
+    """Распределение длительностей по корзинам с суммой и числом наблюдений."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def stats(self) -> dict[tuple, tuple[int, float, float]]:
+        """Возвращает {метки: (число, сумма, оценка p95 по корзинам)}."""
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        result = {}
+        for key, (counts, total) in values.items():
+            count = sum(counts)
+            rank, seen, p95 = 0.95 * count, 0, float("inf")
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                seen += bucket_count
+                if seen >= rank:
+                    p95 = bound
+                    break
+            result[key] = (count, total, p95)
+        return result
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: list[Metric] = []
+
+handler_seconds = Histogram("bot_handler_seconds", "Время обработки сообщения обработчиком", ("handler",))
+google_api_seconds = Histogram("bot_google_api_seconds", "Время запроса к Google API (с повторами)", ("method",))
+google_api_retries = Counter("bot_google_api_retries_total", "Повторы запросов к Google API", ("method", "status"))
+ocr_stage_seconds = Histogram("bot_ocr_stage_seconds", "Время этапов распознавания фото", ("stage",))
+cache_requests = Counter("bot_cache_requests_total", "Обращения к кэшам", ("cache", "result"))
+
+
+def gauge(name: str, help_text: str, func, labels: tuple = ()) -> Gauge:
+    """Регистрирует показатель, вычисляемый при выгрузке (очереди, размеры)."""
+    return Gauge(name, help_text, func, labels)
+
+
+_lru_caches = {}  # имя кэша -> cache_info функции с functools.lru_cache
+
+
+def register_lru(cache: str, func):
+    """Добавляет попадания functools.lru_cache функции в bot_lru_cache_requests."""
+    _lru_caches[cache] = func.cache_info
+
+
+gauge(
+    "bot_lru_cache_requests", "Обращения к lru_cache (клавиатуры)",
+    lambda: {key: value for cache, info in _lru_caches.items()
+             for key, value in (((cache, "hit"), info().hits), ((cache, "miss"), info().misses))},
+    ("cache", "result")
+)
+
+
+def hit_ratios() -> dict[str, float]:
+    """Доля попаданий по каждому кэшу."""
+    totals = {}
+    for (cache, result), value in list(cache_requests._values.items()):
+        hits, all_requests = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (value if result == "hit" else 0), all_requests + value)
+    for cache, info in _lru_caches.items():
+        totals[cache] = (info().hits, info().hits + info().misses)
+    return {cache: hits / total for cache, (hits, total) in totals.items() if total}
+
+
+def render() -> str:
+    """Все показатели в текстовом формате Prometheus."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def summary(limit: int = 10) -> str:
+    """Краткая сводка для команды /metrics: самые затратные обработчики и запросы, очереди, кэши."""
+    lines = []
+    for title, histogram in (("Обработчики", handler_seconds), ("Google API", google_api_seconds), ("Этапы OCR", ocr_stage_seconds)):
+        stats = sorted(histogram.stats().items(), key=lambda item: -item[1][1])[:limit]
+        if not stats:
+            continue
+        lines.append(f"{title} (вызовов, среднее, p95):")
+        lines += [f"  {key[0]}: {count}, {total / count * 1000:.0f} мс, ≤{p95 * 1000:.0f} мс" for key, (count, total, p95) in stats]
+    queues = [(metric.name.removeprefix("bot_"), value) for metric in REGISTRY
+              if isinstance(metric, Gauge) and not metric.label_names for value in metric.current().values()]
+    if queues:
+        lines.append("Очереди и размеры:")
+        lines += [f"  {name}: {value}" for name, value in queues]
+    ratios = hit_ratios()
+    if ratios:
+        lines.append("Попадания в кэш:")
+        lines += [f"  {cache}: {ratio:.0%}" for cache, ratio in sorted(ratios.items())]
+    return "\n".join(lines) or "Данных пока нет."
+
+
+async def start_server(host: str, port: int):
+    """Запускает локальный HTTP-сервер с /metrics; возвращает runner для остановки."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from config import OCR_WORKERS, OCR_QUEUE_SIZE, OCR_TIMEOUT, OCR_CACHE_SIZE, OCR_CACHE_PATH, OCR_CACHE_FLUSH_INTERVAL
+from metrics import ocr_stage_seconds, cache_requests, gauge
+from utils import process_image, extract_gem_info
+
+
+class OcrBusyError(Exception):
+    """Очередь распознавания заполнена."""
+
+
+class OcrPool:
+    """Пул процессов для OCR: ограниченная очередь, таймаут задания и отмена по чату."""
+
+    def __init__(self, workers: int, queue_size: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._slots = asyncio.Semaphore(workers + queue_size)
+        self._active = 0  # Занятых слотов: задания, которые процессы ещё не закончили
+        self._jobs = {}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def recognize(self, key, image: bytes, replace: bool = True, wait: bool = False) -> str | None:
+        """Распознаёт текст на фото; возвращает None, если задание отменено новым фото или действием пользователя.
+
+        replace отменяет прежние задания того же ключа, wait ждёт места в очереди вместо OcrBusyError.
+        """
+        if self._slots.locked() and not wait:
+            raise OcrBusyError
+        if replace:
+            self.cancel(key)
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            job = self._get_executor().submit(process_image, image, self.timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._active += 1
+        # Слот освобождается, когда процесс действительно закончил задание: после таймаута ожидания
+        # зависшее задание продолжает занимать процесс, и новые фото не должны вставать за ним сверх очереди
+        job.add_done_callback(lambda _: self._release_threadsafe(loop))
+        future = asyncio.wrap_future(job)
+        self._jobs.setdefault(key, set()).add(future)
+        try:
+            text, timings = await asyncio.wait_for(future, self.timeout)
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            logging.info(f"OCR job for {key} cancelled")
+            return None
+        finally:
+            jobs = self._jobs.get(key)
+            if jobs is not None:
+                jobs.discard(future)
+                if not jobs:
+                    del self._jobs[key]
+        for stage, elapsed in timings.items():
+            ocr_stage_seconds.observe(elapsed, stage=stage)
+        logging.info("OCR stages: " + ", ".join(f"{stage} {elapsed:.3f}s" for stage, elapsed in timings.items()))
+        return text
+
+    def _release(self):
+        self._active -= 1
+        self._slots.release()
+
+    def _release_threadsafe(self, loop: asyncio.AbstractEventLoop):
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # Цикл уже закрыт при остановке бота
+
+    @property
+    def jobs(self) -> int:
+        """Заданий в работе и в очереди, включая те, чьё ожидание истекло, но процесс ещё занят."""
+        return self._active
+
+    def cancel(self, key):
+        """Отменяет незавершённые задания чата (ещё не начатые задания снимаются с очереди)."""
+        for future in self._jobs.pop(key, ()):
+            future.cancel()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class OcrCache:
+    """LRU-кэш результатов extract_gem_info по file_unique_id и хэшу фото с сохранением на диск.
+
+    put только помечает кэш изменённым; файл перезаписывается в потоке не чаще раза в flush_interval
+    секунд и при остановке бота.
+    """
+
+    def __init__(self, max_size: int, path: str = "", flush_interval: float = 30):
+        self.max_size = max_size
+        self.path = path
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()
+        self._dirty = False
+        self._stopping = asyncio.Event()
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for key, value in json.load(f):
+                        self._entries[key] = tuple(value)
+            except (OSError, ValueError) as e:
+                logging.error(f"Error loading OCR cache: {e}")
+
+    def get(self, key: str) -> tuple | None:
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+        cache_requests.inc(cache="ocr", result="miss" if result is None else "hit")
+        return result
+
+    def put(self, key: str, result: tuple):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def _save(self, entries: list) -> bool:
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            return True
+        except OSError as e:
+            logging.error(f"Error saving OCR cache: {e}")
+            return False
+
+    async def flush(self):
+        """Сохраняет кэш на диск в потоке, если он изменился с прошлого сохранения."""
+        if not self._dirty or not self.path:
+            return
+        self._dirty = False
+        if not await asyncio.to_thread(self._save, list(self._entries.items())):
+            self._dirty = True
+
+    async def run(self):
+        """Сохраняет изменения раз в flush_interval секунд; после stop() — последний раз."""
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def stop(self):
+        """Просит run() сохранить кэш и завершиться."""
+        self._stopping.set()
+
+
+ocr_pool = OcrPool(OCR_WORKERS, OCR_QUEUE_SIZE, OCR_TIMEOUT)
+ocr_cache = OcrCache(OCR_CACHE_SIZE, OCR_CACHE_PATH, OCR_CACHE_FLUSH_INTERVAL)
+gauge("bot_ocr_queue_depth", "Заданий OCR в работе и в очереди", lambda: ocr_pool.jobs)
+
+
+async def recognize_photo(bot, photo, key, replace: bool = True, wait: bool = False) -> tuple | None:
+    """Возвращает (gem, expiry, tests) для фото; повторное фото берётся из кэша без загрузки и OCR."""
+    result = ocr_cache.get(photo.file_unique_id)
+    if result is not None:
+        return result
+    file = await bot.get_file(photo.file_id)
+    image = (await bot.download_file(file.file_path)).read()
+    digest = hashlib.sha256(image).hexdigest()
+    result = ocr_cache.get(digest)
+    if result is None:
+        text = await ocr_pool.recognize(key, image, replace=replace, wait=wait)
+        if text is None:
+            return None
+        result = extract_gem_info(text)
+        ocr_cache.put(digest, result)
+    ocr_cache.put(photo.file_unique_id, result)
+    return result
@@ -0,0 +1,367 @@
+import asyncio
+import json
+import logging
+import os
+import shlex
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from itertools import compress
+from operator import and_
+from config import HISTORY_STORE_PATH, HISTORY_EXPORT_INTERVAL
+from sheets import sheets_ctx, run_sheets
+from ledger import Ledger, ledger
+from history import HistoryWriter, history_writer
+from utils import parse_expiry
+
+# Столбцы строки истории в порядке ARCHIVE_HEADER; строковые хранятся кодами общего словаря
+COLUMNS = ("who", "hospital", "purpose", "model", "tests", "qty", "expiry", "day", "type")
+STRING_COLUMNS = ("who", "hospital", "purpose", "model", "tests", "expiry", "type")
+SEGMENT_ROWS = 50000  # Строк архива в одном сегменте
+
+REPORT_FIELDS = {"кто": "who", "куда": "hospital", "зачем": "purpose", "модель": "model", "тесты": "tests", "тип": "type"}
+REPORT_PERIODS = {"месяц": "month", "квартал": "quarter", "год": "year"}
+PERIOD_LABELS = {
+    "month": lambda d: f"{d.month:02d}.{d.year}",
+    "quarter": lambda d: f"{(d.month - 1) // 3 + 1} кв. {d.year}",
+    "year": lambda d: str(d.year),
+}
+GROUP_TITLES = {**{column: title for title, column in REPORT_FIELDS.items()}, **{column: title for title, column in REPORT_PERIODS.items()}}
+
+REPORT_HELP = (
+    "Отчёт по истории операций: /report [период=...] [по=поле,...] [поле=значение,...]\n"
+    "Период: месяц, квартал, год, прошлый_месяц, прошлый_квартал, прошлый_год, всё "
+    "или дд.мм.гггг-дд.мм.гггг (по умолчанию месяц).\n"
+    "Группировка по: куда, зачем, модель, тесты, кто, тип, месяц, квартал, год (по умолчанию куда).\n"
+    "Фильтры: куда, зачем, модель, тесты, кто, тип (по умолчанию тип=Выдача; тип=все — все операции).\n"
+    'Пример: /report период=прошлый_квартал куда="ГКБ 1" модель=5000 тесты=450 по=месяц'
+)
+
+
+class Columns:
+    """Столбцы строк истории в типизированных массивах: коды словаря, количество, день операции."""
+
+    def __init__(self):
+        self.data = {column: array("I" if column in STRING_COLUMNS else "i") for column in COLUMNS}
+
+    def __len__(self) -> int:
+        return len(self.data["day"])
+
+    def extend(self, other: "Columns"):
+        for column in COLUMNS:
+            self.data[column].extend(other.data[column])
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(b"".join(self.data[column].tobytes() for column in COLUMNS), 1)
+
+    @classmethod
+    def from_bytes(cls, blob: bytes, rows: int) -> "Columns":
+        columns, raw, offset = cls(), zlib.decompress(blob), 0
+        for column in COLUMNS:
+            values = columns.data[column]
+            size = rows * values.itemsize
+            values.frombytes(raw[offset:offset + size])
+            offset += size
+        return columns
+
+
+class HistoryStore:
+    """Локальная колоночная копия листов истории и архива для отчётов.
+
+    Архив только дописывается, поэтому его строки сохраняются неизменяемыми сегментами от последней
+    выгруженной строки. Лист истории невелик (его переносит архиватор) и хранится целиком отдельным
+    хвостом, который заменяется при каждой выгрузке. Загрузка с диска — при первом обращении.
+    Методы блокирующие и вызываются из потоков (asyncio.to_thread); общая блокировка не даёт отчёту
+    увидеть архив и хвост из разных выгрузок.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._meta = None
+        self._codes = {}
+        self._days = {}
+        self._lock = threading.RLock()
+        self.archive = Columns()
+        self.tail = Columns()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @property
+    def meta(self) -> dict:
+        with self._lock:
+            if self._meta is None:
+                self._load()
+            return self._meta
+
+    def load(self):
+        """Читает хранилище с диска, если оно ещё не загружено."""
+        self.meta
+
+    def _load(self):
+        self._meta = {"archive_rows": 1, "segments": [], "tail_rows": 0, "ledger_bound": 1, "dictionary": []}
+        if os.path.exists(self._file("meta.json")):
+            with open(self._file("meta.json"), encoding="utf-8") as f:
+                self._meta.update(json.load(f))
+        self._codes = {value: code for code, value in enumerate(self._meta["dictionary"])}
+        for segment in self._meta["segments"]:
+            with open(self._file(segment["file"]), "rb") as f:
+                self.archive.extend(Columns.from_bytes(f.read(), segment["rows"]))
+        if self._meta["tail_rows"]:
+            with open(self._file("tail.col"), "rb") as f:
+                self.tail = Columns.from_bytes(f.read(), self._meta["tail_rows"])
+
+    def _write(self, name: str, payload: bytes):
+        """Запись через временный файл: прерванная выгрузка не портит хранилище."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(name + ".tmp"), "wb") as f:
+            f.write(payload)
+        os.replace(self._file(name + ".tmp"), self._file(name))
+
+    def _save_meta(self):
+        self._write("meta.json", json.dumps(self._meta, ensure_ascii=False).encode("utf-8"))
+
+    def _code(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.meta["dictionary"])
+            self.meta["dictionary"].append(value)
+        return code
+
+    def _day(self, value: str) -> int:
+        """День операции по «дд.мм.гггг чч:мм»; 0 — дата не распознана."""
+        value = value.strip().split(" ")[0]
+        day = self._days.get(value)
+        if day is None:
+            parsed = parse_expiry(value) if value else None
+            day = self._days[value] = parsed.toordinal() if parsed else 0
+        return day
+
+    def _value(self, column: str, cell) -> int:
+        cell = str(cell).strip()
+        if column == "qty":
+            return int(cell) if cell.lstrip("-").isdigit() else 0
+        return self._code(cell)
+
+    def encode(self, rows: list[list]) -> Columns:
+        """Переводит строки листа в столбцы; короткие строки дополняются пустыми ячейками.
+
+        Каждое уникальное значение столбца разбирается один раз, сам столбец собирается через map.
+        """
+        width = len(COLUMNS)
+        rows = [list(row[:width]) + [""] * (width - len(row)) for row in rows if any(row)]
+        columns = Columns()
+        for column, cells in zip(COLUMNS, zip(*rows)):
+            if column == "day":  # Время операции почти всегда уникально, кэш — по дате
+                columns.data[column].extend(map(self._day, map(str, cells)))
+                continue
+            values = {cell: self._value(column, cell) for cell in set(cells)}
+            columns.data[column].extend(map(values.__getitem__, cells))
+        return columns
+
+    @property
+    def archive_rows(self) -> int:
+        """Строк архива (с заголовком), уже перенесённых в хранилище."""
+        return self.meta["archive_rows"]
+
+    def update(self, archive: list[list], history: list[list], ledger_bound: int):
+        """Дописывает новые строки архива сегментами и заменяет копию листа истории.
+
+        ledger_bound — id первой строки журнала, которой в листах ещё нет.
+        """
+        with self._lock:
+            for start in range(0, len(archive), SEGMENT_ROWS):
+                rows = archive[start:start + SEGMENT_ROWS]
+                columns = self.encode(rows)
+                name = f"archive-{len(self.meta['segments']):06d}.col"
+                self._write(name, columns.to_bytes())
+                self.archive.extend(columns)
+                self.meta["segments"].append({"file": name, "rows": len(columns)})
+                self.meta["archive_rows"] += len(rows)
+            self.tail = self.encode(history)
+            self._write("tail.col", self.tail.to_bytes())
+            self.meta["tail_rows"] = len(self.tail)
+            self.meta["ledger_bound"] = ledger_bound
+            self._save_meta()
+
+    def _filter_codes(self, values: list[str]) -> set[int]:
+        wanted = {value.casefold() for value in values}
+        return {code for code, value in enumerate(self.meta["dictionary"]) if value.casefold() in wanted}
+
+    @staticmethod
+    def _group_column(part: Columns, column: str):
+        if column not in PERIOD_LABELS:
+            return part.data[column]
+        label = PERIOD_LABELS[column]
+        labels = {day: label(date.fromordinal(day)) if day else "без даты" for day in set(part.data["day"])}
+        return map(labels.__getitem__, part.data["day"])
+
+    def aggregate(self, recent: list[tuple[int, list]], start: date | None, end: date | None,
+                  filters: dict[str, list[str]], group_by: list[str]) -> tuple[list[tuple[tuple, int, int]], int]:
+        """Суммы количества и число операций по группам: ([(значения группы, штук, операций)], строк просмотрено).
+
+        Отбор строится масками по целым столбцам, группировка — по кортежам кодов. Из строк журнала
+        (id, строка) берутся те, которых ещё нет в листах на момент последней выгрузки, и кодируются на лету.
+        """
+        with self._lock:
+            return self._aggregate(recent, start, end, filters, group_by)
+
+    def _aggregate(self, recent, start, end, filters, group_by):
+        dictionary = self.meta["dictionary"]
+        recent = [row for row_id, row in recent if row_id >= self.meta["ledger_bound"]]
+        first = start.toordinal() if start else 0
+        last = end.toordinal() if end else date.max.toordinal()
+        codes = {column: self._filter_codes(values) for column, values in filters.items()}
+        quantities, operations, scanned = defaultdict(int), Counter(), 0
+        for part in (self.archive, self.tail, self.encode(recent)):
+            scanned += len(part)
+            mask = [first <= day <= last for day in part.data["day"]]
+            for column, allowed in codes.items():
+                mask = list(map(and_, mask, map(allowed.__contains__, part.data[column])))
+            keys = list(zip(*(compress(self._group_column(part, column), mask) for column in group_by)))
+            operations.update(keys)
+            for key, qty in zip(keys, compress(part.data["qty"], mask)):
+                quantities[key] += qty
+        groups = [
+            (tuple(value if column in PERIOD_LABELS else dictionary[value] for column, value in zip(group_by, key)), qty, operations[key])
+            for key, qty in quantities.items()
+        ]
+        return groups, scanned
+
+
+def period_bounds(period: str, today: date) -> tuple[date | None, date | None]:
+    """Границы периода отчёта включительно; (None, None) — вся история."""
+    quarter_start = date(today.year, (today.month - 1) // 3 * 3 + 1, 1)
+    if period == "месяц":
+        return today.replace(day=1), today
+    if period == "квартал":
+        return quarter_start, today
+    if period == "год":
+        return date(today.year, 1, 1), today
+    if period == "прошлый_месяц":
+        end = today.replace(day=1) - timedelta(days=1)
+        return end.replace(day=1), end
+    if period == "прошлый_квартал":
+        end = quarter_start - timedelta(days=1)
+        return date(end.year, (end.month - 1) // 3 * 3 + 1, 1), end
+    if period == "прошлый_год":
+        return date(today.year - 1, 1, 1), date(today.year - 1, 12, 31)
+    if period in ("всё", "все"):
+        return None, None
+    start, _, end = period.partition("-")
+    start, end = parse_expiry(start), parse_expiry(end)
+    if not start or not end or start > end:
+        raise ValueError(f"Неизвестный период: {period}")
+    return start, end
+
+
+def parse_report_args(args: str) -> tuple[str, list[str], dict[str, list[str]]]:
+    """Разбирает аргументы /report: (период, группировка, фильтры)."""
+    period, group_by, filters = "месяц", ["hospital"], {"type": ["Выдача"]}
+    for token in shlex.split(args):
+        name, sep, value = token.partition("=")
+        name = name.lower()
+        if not sep or not value:
+            raise ValueError(f"Ожидается поле=значение: {token}")
+        if name == "период":
+            period = value.lower()
+        elif name == "по":
+            group_by = []
+            for title in value.lower().split(","):
+                column = REPORT_FIELDS.get(title) or REPORT_PERIODS.get(title)
+                if not column:
+                    raise ValueError(f"Нельзя группировать по: {title}")
+                group_by.append(column)
+        elif name in REPORT_FIELDS:
+            if REPORT_FIELDS[name] == "type" and value.lower() == "все":
+                filters.pop("type", None)
+            else:
+                filters[REPORT_FIELDS[name]] = [part.strip() for part in value.split(",")]
+        else:
+            raise ValueError(f"Неизвестное поле: {name}")
+    return period, group_by, filters
+
+
+def build_report(store: HistoryStore, recent: list[tuple[int, list]], args: str, limit: int = 50) -> str:
+    """Текст отчёта по аргументам /report; ошибка разбора — ValueError с пояснением. Блокирующий вызов."""
+    started = time.perf_counter()
+    period, group_by, filters = parse_report_args(args)
+    start, end = period_bounds(period, date.today())
+    groups, scanned = store.aggregate(recent, start, end, filters, group_by)
+    groups.sort(key=lambda group: (-group[1], group[0]))
+    span = f"{start:%d.%m.%Y}–{end:%d.%m.%Y}" if start else "вся история"
+    lines = [f"Отчёт за {span}, по: {', '.join(GROUP_TITLES[column] for column in group_by)}"]
+    if filters:
+        lines.append("Фильтры: " + "; ".join(
+            f"{GROUP_TITLES[column]}={','.join(values)}" for column, values in filters.items()
+        ))
+    lines += [f"  - {' / '.join(value or '—' for value in key)}: {qty} шт. ({ops} оп.)" for key, qty, ops in groups[:limit]]
+    if len(groups) > limit:
+        lines.append(f"  … ещё групп: {len(groups) - limit}")
+    if not groups:
+        lines.append("Нет операций.")
+    lines.append(
+        f"Итого: {sum(qty for _, qty, _ in groups)} шт., {sum(ops for _, _, ops in groups)} оп. "
+        f"Строк просмотрено: {scanned}, {(time.perf_counter() - started) * 1000:.0f} мс."
+    )
+    return "\n".join(lines)
+
+
+async def report(store: HistoryStore, ledger: Ledger, args: str) -> str:
+    """Строит отчёт /report в потоке: загрузка хранилища и агрегация не занимают цикл событий.
+
+    Строки журнала читаются здесь (соединение SQLite принадлежит потоку цикла) от уже известной
+    границы; граница только растёт, поэтому лишние строки отсекаются в aggregate.
+    """
+    await asyncio.to_thread(store.load)
+    recent = ledger.history_since(store.meta["ledger_bound"])
+    return await asyncio.to_thread(build_report, store, recent, args)
+
+
+class HistoryExporter:
+    """Фоновая выгрузка листов истории и архива в колоночное хранилище.
+
+    Из архива читаются только строки после уже выгруженных; лист истории читается целиком, пока
+    отправка истории приостановлена, чтобы перенос в архив и дописывание не попали между чтениями.
+    """
+
+    def __init__(self, store: HistoryStore, writer: HistoryWriter, ledger: Ledger, interval: float):
+        self.store = store
+        self.writer = writer
+        self.ledger = ledger
+        self.interval = interval
+        self._stopping = asyncio.Event()
+
+    async def export(self):
+        """Дописывает новые строки архива и обновляет копию листа истории."""
+        await asyncio.to_thread(self.store.load)
+        async with self.writer.paused():
+            archive = await run_sheets(lambda: sheets_ctx.archive_sheet.get(f"A{self.store.archive_rows + 1}:I"))
+            history = await run_sheets(lambda: sheets_ctx.history_sheet.get("A2:I"))
+            ledger_bound = self.ledger.first_unsynced_history_id()
+        await asyncio.to_thread(self.store.update, archive, history, ledger_bound)
+        if archive:
+            logging.info(f"Exported {len(archive)} archived history rows")
+
+    async def run(self):
+        """Выгружает историю раз в interval секунд до вызова stop()."""
+        while not self._stopping.is_set():
+            try:
+                await self.export()
+            except Exception as e:
+                logging.error(f"Error exporting history: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        """Просит run() завершиться после текущей выгрузки."""
+        self._stopping.set()
+
+
+history_store = HistoryStore(HISTORY_STORE_PATH)
+history_exporter = HistoryExporter(history_store, history_writer, ledger, HISTORY_EXPORT_INTERVAL)
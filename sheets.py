@@ -1,123 +1,496 @@
 import gspread
+import requests
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+from gspread.utils import a1_to_rowcol, rowcol_to_a1, absolute_range_name
 from oauth2client.service_account import ServiceAccountCredentials
-from config import SCOPE, SHEET_NAME, ARCHIVE_SHEET_NAME
+from config import (
+    SCOPE, SHEET_NAME, ARCHIVE_SHEET_NAME, SHEETS_MAX_WORKERS, CATALOG_TTL, EDAN_PRODUCTS,
+    SHEETS_REQUESTS_PER_MINUTE, SHEETS_BURST, SHEETS_MAX_RETRIES, SHEETS_BACKOFF_MAX
+)
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from http import HTTPStatus
+from metrics import google_api_seconds, google_api_retries, cache_requests, gauge
+from urllib.parse import urlsplit
+import asyncio
+import functools
 import logging
+import random
+import threading
+import time
 
-try:
-    client = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_name("credentials.json", SCOPE))
-    stock_sheet = client.open(SHEET_NAME).sheet1
-    history_sheet = client.open(SHEET_NAME).worksheet("История операций")
-    edan_sheet = client.open(SHEET_NAME).worksheet("Edan")
-    getein_sheet = client.open(SHEET_NAME).worksheet("Getein")
+class TokenBucket:
+    """Потокобезопасное ведро токенов: не более rate запросов в секунду при допустимом всплеске burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Забирает токен, при необходимости ожидая его пополнения."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Неидемпотентные методы: если ответ потерян после выполнения, повтор дописал бы строки ещё раз
+NON_IDEMPOTENT = {"values:append"}
+
+def is_quota_error(error: Exception) -> bool:
+    """429 и 403 usageLimits: запрос отклонён квотой и точно не выполнен."""
+    if not isinstance(error, APIError):
+        return False
+    if error.code == HTTPStatus.TOO_MANY_REQUESTS:
+        return True
+    errors = error.error.get("errors") or [{}]
+    return error.code == HTTPStatus.FORBIDDEN and errors[0].get("domain") == "usageLimits"
+
+def is_retryable(error: Exception, method: str = "") -> bool:
+    """Квоты повторяются всегда; таймауты и ошибки сервера — только для идемпотентных методов."""
+    if is_quota_error(error):
+        return True
+    if method in NON_IDEMPOTENT:
+        return False
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if not isinstance(error, APIError):
+        return False
+    return error.code == HTTPStatus.REQUEST_TIMEOUT or error.code >= HTTPStatus.INTERNAL_SERVER_ERROR
+
+def api_method(method: str, url: str) -> str:
+    """Короткое имя метода Google API для метрик: values:batchGet, values:append, values.get, batchUpdate..."""
+    path = urlsplit(url).path
+    if "/drive/" in path:
+        return f"drive.{method.lower()}"
+    if "/values" in path:
+        tail = path.split("/values", 1)[1]
+        if tail.startswith(":"):
+            return "values" + tail
+        for action in ("append", "clear"):
+            if tail.endswith(":" + action):
+                return "values:" + action
+        return f"values.{method.lower()}"
+    if path.endswith(":batchUpdate"):
+        return "batchUpdate"
+    return f"spreadsheets.{method.lower()}"
+
+class QuotaHTTPClient(HTTPClient):
+    """HTTP-клиент gspread: каждый запрос проходит через общее ведро токенов и повторяется с экспоненциальной паузой."""
+
+    bucket = TokenBucket(SHEETS_REQUESTS_PER_MINUTE / 60, SHEETS_BURST)
+    max_retries = SHEETS_MAX_RETRIES
+    backoff_max = SHEETS_BACKOFF_MAX
+
+    def request(self, method: str, endpoint: str, *args, **kwargs):
+        name = api_method(method, endpoint)
+        with google_api_seconds.time(method=name):
+            return self._request(name, method, endpoint, *args, **kwargs)
+
+    def _request(self, name: str, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return super().request(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e, name):
+                    raise
+                google_api_retries.inc(method=name, status=getattr(e, "code", type(e).__name__))
+                retry_after = getattr(getattr(e, "response", None), "headers", {}).get("Retry-After", "")
+                # Полный джиттер: одновременные запросы не повторяются синхронно
+                wait = float(retry_after) if retry_after.isdigit() else random.uniform(0, min(self.backoff_max, 2 ** attempt))
+                logging.warning(f"Google API request failed ({e}), retry {attempt + 1} in {wait:.1f}s")
+                time.sleep(wait)
+
+ARCHIVE_HEADER = ["Кто", "Куда", "Зачем", "GEM", "Тесты", "Количество", "Срок", "Дата операции", "Тип операции"]
+
+class SheetsContext:
+    """Ленивое подключение к Google Sheets: одна авторизация, одно открытие таблицы, листы — при первом обращении."""
+
+    WORKSHEETS = {"history_sheet": "История операций", "edan_sheet": "Edan", "getein_sheet": "Getein"}
+    SHEETS = {"stock_sheet", "archive_sheet", *WORKSHEETS}
+
+    def __init__(self, credentials_path: str, sheet_name: str, archive_name: str):
+        self.credentials_path = credentials_path
+        self.sheet_name = sheet_name
+        self.archive_name = archive_name
+        self._client = None
+        self._doc = None
+        self._sheets = {}
+        self._lock = threading.RLock()
+
+    @property
+    def client(self) -> gspread.Client:
+        with self._lock:
+            if self._client is None:
+                credentials = ServiceAccountCredentials.from_json_keyfile_name(self.credentials_path, SCOPE)
+                self._client = gspread.authorize(credentials, http_client=QuotaHTTPClient)
+            return self._client
+
+    @property
+    def doc(self) -> gspread.Spreadsheet:
+        with self._lock:
+            if self._doc is None:
+                self._doc = self.client.open(self.sheet_name)
+            return self._doc
+
+    def _open_archive(self) -> gspread.Worksheet:
+        try:
+            return self.client.open(self.archive_name).sheet1
+        except gspread.SpreadsheetNotFound:
+            archive_sheet = self.client.create(self.archive_name).sheet1
+            archive_sheet.append_row(ARCHIVE_HEADER)
+            return archive_sheet
+
+    def worksheet(self, name: str) -> gspread.Worksheet:
+        """Возвращает лист по имени атрибута, открывая его при первом обращении."""
+        with self._lock:
+            if name not in self._sheets:
+                try:
+                    if name == "stock_sheet":
+                        self._sheets[name] = self.doc.sheet1
+                    elif name == "archive_sheet":
+                        self._sheets[name] = self._open_archive()
+                    else:
+                        self._sheets[name] = self.doc.worksheet(self.WORKSHEETS[name])
+                except Exception as e:
+                    logging.error(f"Failed to initialize Google Sheets: {e}")
+                    raise
+            return self._sheets[name]
+
+    def __getattr__(self, name: str):
+        if name in self.SHEETS:
+            return self.worksheet(name)
+        raise AttributeError(name)
+
+sheets_ctx = SheetsContext("credentials.json", SHEET_NAME, ARCHIVE_SHEET_NAME)
+
+def __getattr__(name: str):
+    """Обращение к sheets.stock_sheet и другим листам открывает их лениво, а не при импорте модуля."""
+    if name in SheetsContext.SHEETS:
+        return sheets_ctx.worksheet(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Пул потоков для блокирующих вызовов gspread: фиксированный предел параллельных запросов
+_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+gauge("bot_sheets_queue_depth", "Вызовов Google Sheets в очереди пула потоков", lambda: _executor._work_queue.qsize())
+
+_queued = {}  # ключ объединения -> ещё не начатый вызов
+
+async def run_sheets(func, *args, coalesce_key=None, **kwargs):
+    """Выполняет блокирующий вызов Google Sheets в пуле потоков, не останавливая цикл событий.
+
+    Вызовы с одинаковым coalesce_key, поставленные в очередь до начала выполнения первого,
+    объединяются в один запрос и получают общий результат.
+    """
+    loop = asyncio.get_running_loop()
+    if coalesce_key is None:
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    future = _queued.get(coalesce_key)
+    if future is None:
+        def call():
+            loop.call_soon_threadsafe(_queued.pop, coalesce_key, None)
+            return func(*args, **kwargs)
+        future = _queued[coalesce_key] = loop.run_in_executor(_executor, call)
+    return await asyncio.shield(future)
+
+# Раскладка блоков GEM на листе склада: столбец дат и столбцы тестов
+COL_MAP = {
+    "3500": {"date": 1, "150": 2, "300": 3, "450": 4, "600": 5},
+    "4000": {"date": 6, "150": 7, "300": 8, "450": 9, "600": 10},
+    "5000": {"date": 11, "150": 12, "300": 13, "450": 14, "600": 15}
+}
+FIRST_STOCK_ROW = 9
+LAST_STOCK_ROW = 200
+
+def format_expiry(expiry: str) -> str:
+    """Приводит срок годности к формату дд.мм.гггг."""
     try:
-        archive_doc = client.open(ARCHIVE_SHEET_NAME)
-        archive_sheet = archive_doc.sheet1
-    except gspread.SpreadsheetNotFound:
-        archive_doc = client.create(ARCHIVE_SHEET_NAME)
-        archive_sheet = archive_doc.sheet1
-        archive_sheet.append_row(["Кто", "Куда", "Зачем", "GEM", "Тесты", "Количество", "Срок", "Дата операции", "Тип операции"])
-except Exception as e:
-    logging.error(f"Failed to initialize Google Sheets: {e}")
-    raise
-
-def update_stock(gem: str, test: str, expiry: str, qty_change: int = 1):
+        return datetime.strptime(expiry, "%Y-%m-%d").strftime("%d.%m.%Y")
+    except ValueError:
+        return expiry
+
+def gem_range(gem: str) -> str:
+    """Возвращает A1-диапазон блока GEM (даты и все столбцы тестов)."""
+    first_col = COL_MAP[gem]["date"]
+    last_col = max(COL_MAP[gem].values())
+    return f"{rowcol_to_a1(FIRST_STOCK_ROW, first_col)}:{rowcol_to_a1(LAST_STOCK_ROW, last_col)}"
+
+STOCK_RANGE = f"{rowcol_to_a1(FIRST_STOCK_ROW, 1)}:{rowcol_to_a1(LAST_STOCK_ROW, max(max(cols.values()) for cols in COL_MAP.values()))}"
+
+def _to_int(value) -> int:
     try:
-        col_map = {
-            "3500": {"date": 1, "150": 2, "300": 3, "450": 4, "600": 5},
-            "4000": {"date": 6, "150": 7, "300": 8, "450": 9, "600": 10},
-            "5000": {"date": 11, "150": 12, "300": 13, "450": 14, "600": 15}
-        }
-        date_col = col_map[gem]["date"]
-        test_col = col_map[gem][test]
-        try:
-            date_obj = datetime.strptime(expiry, "%Y-%m-%d")
-            expiry_formatted = date_obj.strftime("%d.%m.%Y")
-        except ValueError:
-            expiry_formatted = expiry
+        return int(value or 0)
+    except ValueError:
+        return 0
+
+def _cell_count(values: list, cell: str) -> int:
+    """Число из отдельной ячейки-счётчика (значения как в ответе API); нечисловое значение считается 0."""
+    raw = str(values[0][0]).strip() if values and values[0] else ""
+    if raw and not raw.lstrip("-").isdigit():
+        logging.warning(f"Non-numeric value {raw!r} in {cell}, treated as 0")
+    return _to_int(raw)
+
+class StockCache:
+    """Остатки GEM, прочитанные из таблицы: снимок для сверки с журналом."""
+
+    def __init__(self):
+        self._lots = {gem: [] for gem in COL_MAP}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse_block(gem: str, rows: list, col_offset: int = 0) -> list:
+        """Разбирает строки блока GEM в список [срок, {тесты: количество}]."""
+        date_col = COL_MAP[gem]["date"]
+        lots = []
+        for values in rows:
+            date = values[col_offset].strip() if len(values) > col_offset else ""
+            if not date:
+                continue
+            qty = {}
+            for test, col in COL_MAP[gem].items():
+                if test == "date":
+                    continue
+                idx = col_offset + col - date_col
+                qty[test] = _to_int(values[idx] if idx < len(values) else 0)
+            lots.append([date, qty])
+        return lots
+
+    def load_rows(self, rows: list, gems=COL_MAP):
+        """Заменяет блоки gems строками диапазона STOCK_RANGE."""
+        with self._lock:
+            for gem in gems:
+                self._lots[gem] = self._parse_block(gem, rows, COL_MAP[gem]["date"] - 1)
+
+    def snapshot(self) -> dict[tuple[str, str, str], int]:
+        """Возвращает остатки в виде {(gem, тесты, срок): количество} в порядке строк таблицы."""
+        with self._lock:
+            return {(gem, test, date): qty[test] for gem, lots in self._lots.items() for date, qty in lots for test in qty}
+
+stock_cache = StockCache()
+
+def apply_stock_changes(changes: list[tuple[str, str, str, int]], applied: list):
+    """Применяет изменения остатков GEM (gem, тесты, срок, изменение): одно чтение блоков и одна пакетная запись.
 
-        for row in range(9, 201):
-            cell_value = stock_sheet.cell(row, date_col).value
+    Ключи, записанные в таблицу, дописываются в applied; остальные остаются в очереди репликации.
+    """
+    gems = list(dict.fromkeys(gem for gem, _, _, _ in changes))
+    blocks = dict(zip(gems, sheets_ctx.stock_sheet.batch_get([gem_range(gem) for gem in gems])))
+    height = LAST_STOCK_ROW - FIRST_STOCK_ROW + 1
+    grids = {}
+    for gem, block in blocks.items():
+        width = max(COL_MAP[gem].values()) - COL_MAP[gem]["date"] + 1
+        grids[gem] = [list(values) + [""] * (width - len(values)) for values in block]
+        grids[gem] += [[""] * width for _ in range(height - len(block))]
+
+    updates = {}
+    written = []
+    for gem, test, expiry, qty_change in changes:
+        date_col = COL_MAP[gem]["date"]
+        test_col = COL_MAP[gem][test]
+        test_offset = test_col - date_col
+        expiry_formatted = format_expiry(expiry)
+        # Изменения применяются и к локальной копии блока, чтобы несколько строк одного блока не конфликтовали
+        for i, values in enumerate(grids[gem]):
+            row = FIRST_STOCK_ROW + i
+            cell_value = values[0]
             if not cell_value:
-                stock_sheet.update_cell(row, date_col, expiry_formatted)
-                stock_sheet.update_cell(row, test_col, qty_change if test == test else 0)
+                values[0] = expiry_formatted
+                values[test_offset] = new_qty = qty_change
+                updates[rowcol_to_a1(row, date_col)] = expiry_formatted
+                updates[rowcol_to_a1(row, test_col)] = new_qty
                 break
-            if cell_value.strip() == expiry_formatted:
-                current_qty = int(stock_sheet.cell(row, test_col).value or 0)
-                stock_sheet.update_cell(row, test_col, max(0, current_qty + qty_change))
+            if str(cell_value).strip() == expiry_formatted:
+                values[test_offset] = new_qty = max(0, _to_int(values[test_offset]) + qty_change)
+                updates[rowcol_to_a1(row, test_col)] = new_qty
                 break
-    except Exception as e:
-        logging.error(f"Error updating stock: {e}")
-        raise
-
-client = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_name("credentials.json", SCOPE))
-
-# Подключение к таблицам
-stock_sheet = client.open(SHEET_NAME).sheet1
-history_sheet = client.open(SHEET_NAME).worksheet("История операций")
-edan_sheet = client.open(SHEET_NAME).worksheet("Edan")
-getein_sheet = client.open(SHEET_NAME).worksheet("Getein")
-try:
-    archive_doc = client.open(ARCHIVE_SHEET_NAME)
-    archive_sheet = archive_doc.sheet1
-except gspread.SpreadsheetNotFound:
-    archive_doc = client.create(ARCHIVE_SHEET_NAME)
-    archive_sheet = archive_doc.sheet1
-    archive_sheet.append_row(["Кто", "Куда", "Зачем", "GEM", "Тесты", "Количество", "Срок", "Дата операции", "Тип операции"])
-
-def update_stock(gem: str, test: str, expiry: str, qty_change: int = 1):
-    """Обновляет остатки в таблице склада."""
-    col_map = {
-        "3500": {"date": 1, "150": 2, "300": 3, "450": 4, "600": 5},
-        "4000": {"date": 6, "150": 7, "300": 8, "450": 9, "600": 10},
-        "5000": {"date": 11, "150": 12, "300": 13, "450": 14, "600": 15}
+        else:
+            logging.error(f"No free row for GEM {gem} expiry {expiry_formatted}")
+            continue
+        written.append((gem, test, expiry))
+    if not updates:
+        return
+    sheets_ctx.stock_sheet.batch_update(
+        [{"range": a1, "values": [[value]]} for a1, value in updates.items()], value_input_option="USER_ENTERED"
+    )
+    applied.extend(written)
+
+class LotIndex:
+    """Индекс строк листа лотов: ключ (наименование, ..., срок) -> [номер строки, количество]."""
+
+    def __init__(self, get_sheet, key_cols: int):
+        self._get_sheet = get_sheet
+        self.key_cols = key_cols
+        self.qty_col = key_cols + 1
+        self._entries = {}
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.version = 0
+
+    def _key(self, values: list) -> tuple:
+        return tuple((list(values) + [""] * self.key_cols)[:self.key_cols])
+
+    @property
+    def data_range(self) -> str:
+        """Столбцы ключа и количества без заголовка, например A2:D."""
+        return "A2:" + rowcol_to_a1(1, self.qty_col)[:-1]
+
+    def load(self):
+        """Строит индекс по всему листу: перед первой записью и если строки сдвинуты вручную."""
+        with self._lock:
+            self.load_rows(self._get_sheet().get_all_values()[1:])
+
+    def load_rows(self, rows: list):
+        """Строит индекс по строкам листа, начиная со второй."""
+        with self._lock:
+            entries = {}
+            for i, values in enumerate(rows, 2):
+                qty = values[self.key_cols] if len(values) > self.key_cols else 0
+                entries.setdefault(self._key(values), [i, _to_int(qty)])
+            self._entries = entries
+            self.loaded = True
+            self.version += 1
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def snapshot(self) -> dict[tuple, int]:
+        """Возвращает {ключ: количество} из памяти."""
+        with self._lock:
+            return {key: qty for key, (_, qty) in self._entries.items()}
+
+    def names(self) -> set[str]:
+        """Возвращает наименования (первый столбец ключа) из памяти."""
+        with self._lock:
+            return {key[0] for key in self._entries if key[0]}
+
+    def apply_many(self, changes: list[tuple[tuple, int]], applied: list, cells: dict[tuple, str] = None):
+        """Применяет изменения по ключам: одно чтение найденных строк, одна пакетная запись и одно добавление новых.
+
+        cells — ключи, количество которых хранится в отдельной ячейке листа (ключ -> A1); они читаются
+        и записываются в тех же запросах, что и строки. Ключи дописываются в applied сразу после записи, которая их применила: если следующая запись
+        упадёт, повторная отправка не применит их второй раз. Ключи, которые записать не удалось
+        (строка сдвинута, новой партии нечего добавить), в applied не попадают и остаются в очереди.
+        """
+        cells = cells or {}
+        merged = {}
+        for key, qty_change in changes:
+            merged[key] = merged.get(key, 0) + qty_change
+        counters = [key for key in merged if key in cells]
+        with self._lock:
+            self._ensure_loaded()
+            sheet = self._get_sheet()
+            for attempt in range(2):
+                existing = [(key, self._entries[key][0]) for key in merged if key in self._entries and key not in cells]
+                if not existing and not counters:
+                    break
+                ranges = [f"A{row}:{rowcol_to_a1(row, self.qty_col)}" for _, row in existing]
+                blocks = sheet.batch_get(ranges + [cells[key] for key in counters])
+                rows = [block[0] if block else [] for block in blocks[:len(existing)]]
+                if attempt == 0 and any(self._key(values) != key for (key, _), values in zip(existing, rows)):
+                    # Строки сдвинуты вручную: перестраиваем индекс и ищем заново
+                    self.load()
+                    continue
+                updates, written = [], {}
+                for (key, row), values in zip(existing, rows):
+                    if self._key(values) != key:
+                        logging.error(f"Row {row} no longer matches {key}, skipping")
+                        continue
+                    written[key] = new_qty = _to_int(values[self.key_cols] if len(values) > self.key_cols else 0) + merged[key]
+                    updates.append({"range": rowcol_to_a1(row, self.qty_col), "values": [[new_qty]]})
+                for key, values in zip(counters, blocks[len(existing):]):
+                    written[key] = new_qty = _cell_count(values, cells[key]) + merged[key]
+                    updates.append({"range": cells[key], "values": [[new_qty]]})
+                if updates:
+                    sheet.batch_update(updates, value_input_option="USER_ENTERED")
+                    for key, new_qty in written.items():
+                        if key not in cells:
+                            self._entries[key][1] = new_qty
+                    applied.extend(written)
+                break
+            new_rows = []
+            for key, qty in merged.items():
+                if key in self._entries or key in cells:
+                    continue
+                if qty <= 0:
+                    logging.error(f"No row for {key} to apply {qty}, keeping the change pending")
+                    continue
+                new_rows.append(list(key) + [qty])
+            if not new_rows:
+                return
+            response = sheet.append_rows(new_rows)
+            applied.extend(tuple(values[:self.key_cols]) for values in new_rows)
+            updated_range = response.get("updates", {}).get("updatedRange", "")
+            try:
+                first_row = a1_to_rowcol(updated_range.split("!")[-1].split(":")[0])[0]
+            except Exception:
+                self.loaded = False
+                return
+            for i, values in enumerate(new_rows):
+                self._entries[tuple(values[:self.key_cols])] = [first_row + i, values[self.key_cols]]
+            self.version += 1
+
+edan_index = LotIndex(lambda: sheets_ctx.edan_sheet, key_cols=3)
+getein_index = LotIndex(lambda: sheets_ctx.getein_sheet, key_cols=2)
+ANALYZER_CELL = "G2"  # Количество анализаторов Edan
+
+def last_modified() -> str:
+    """Время последнего изменения таблицы по Drive API: один лёгкий запрос вместо чтения листов."""
+    return sheets_ctx.doc.get_lastUpdateTime()
+
+def read_all() -> dict[str, list]:
+    """Читает блоки GEM, листы Edan и Getein и ячейку анализаторов одним запросом values:batchGet."""
+    ranges = {
+        "stock": absolute_range_name(sheets_ctx.stock_sheet.title, STOCK_RANGE),
+        "edan": absolute_range_name(sheets_ctx.edan_sheet.title, edan_index.data_range),
+        "getein": absolute_range_name(sheets_ctx.getein_sheet.title, getein_index.data_range),
+        "analyzers": absolute_range_name(sheets_ctx.edan_sheet.title, ANALYZER_CELL),
     }
-    date_col = col_map[gem]["date"]
-    test_col = col_map[gem][test]
-    try:
-        date_obj = datetime.strptime(expiry, "%Y-%m-%d")
-        expiry_formatted = date_obj.strftime("%d.%m.%Y")
-    except ValueError:
-        expiry_formatted = expiry
-
-    for row in range(9, 201):
-        cell_value = stock_sheet.cell(row, date_col).value
-        if not cell_value:
-            stock_sheet.update_cell(row, date_col, expiry_formatted)
-            stock_sheet.update_cell(row, test_col, qty_change if test == test else 0)
-            break
-        if cell_value.strip() == expiry_formatted:
-            current_qty = int(stock_sheet.cell(row, test_col).value or 0)
-            stock_sheet.update_cell(row, test_col, max(0, current_qty + qty_change))
-            break
-
-async def archive_history():
-    """Архивирует старые записи из истории операций."""
-    ARCHIVE_THRESHOLD = 1000
-    history_rows = history_sheet.get_all_values()
-    if len(history_rows) > ARCHIVE_THRESHOLD:
-        old_rows = history_rows[1:len(history_rows) - 100]
-        archive_sheet.append_rows(old_rows)
-        history_sheet.delete_rows(2, len(old_rows))
-
-# Кэш данных
-preloaded_data = {}
-
-async def refresh_preloaded_data():
-    """Обновляет кэш данных из Google Sheets."""
-    global preloaded_data
-    while True:
-        col_map = {
-            "3500": {"date": 1, "150": 2, "300": 3, "450": 4, "600": 5},
-            "4000": {"date": 6, "150": 7, "300": 8, "450": 9, "600": 10},
-            "5000": {"date": 11, "150": 12, "300": 13, "450": 14, "600": 15}
-        }
-        new_data = {}
-        for gem, mapping in col_map.items():
-            gem_data = {}
-            for key, col in mapping.items():
-                values = stock_sheet.col_values(col)[8:108]
-                gem_data[key] = values
-            new_data[gem] = gem_data
-        preloaded_data = new_data
-        await asyncio.sleep(300)  # Обновление каждые 5 минут
\ No newline at end of file
+    response = sheets_ctx.doc.values_batch_get(list(ranges.values()))
+    return {name: value_range.get("values", []) for name, value_range in zip(ranges, response.get("valueRanges", []))}
+
+class ItemCatalog:
+    """Отсортированные уникальные наименования из индекса лотов; пересборка при добавлении или по TTL."""
+
+    def __init__(self, index: LotIndex, ttl: float, exclude: tuple = ()):
+        self.index = index
+        self.ttl = ttl
+        self.exclude = set(exclude)
+        self._items = ()
+        self._version = None
+        self._built_at = 0.0
+
+    def items(self) -> tuple[str, ...]:
+        """Возвращает наименования без обращения к таблице, если индекс уже загружен."""
+        if self._version != self.index.version or time.monotonic() - self._built_at > self.ttl:
+            cache_requests.inc(cache="catalog", result="miss")
+            self._version = self.index.version
+            self._items = tuple(sorted(self.index.names() - self.exclude))
+            self._built_at = time.monotonic()
+        else:
+            cache_requests.inc(cache="catalog", result="hit")
+        return self._items
+
+edan_catalog = ItemCatalog(edan_index, CATALOG_TTL, exclude=tuple(EDAN_PRODUCTS))
+getein_catalog = ItemCatalog(getein_index, CATALOG_TTL)
+
+def apply_edan_changes(changes: list[tuple[str, str, str, int]], applied: list):
+    """Применяет пакет изменений Edan (наименование, лот, срок, изменение); анализаторы — в отдельной ячейке."""
+    edan_index.apply_many(
+        [((item, lot, expiry), qty_change) for item, lot, expiry, qty_change in changes], applied,
+        cells={("Анализатор Edan", "-", "-"): ANALYZER_CELL}
+    )
+
+def apply_getein_changes(changes: list[tuple[str, str, int]], applied: list):
+    """Применяет пакет изменений Getein (наименование, срок, изменение); применённые ключи — в applied."""
+    getein_index.apply_many([((item, expiry), qty_change) for item, expiry, qty_change in changes], applied)
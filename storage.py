@@ -0,0 +1,183 @@
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+class Session:
+    """Компактная запись сессии чата: состояние, данные диалога, время последнего обращения
+    и последняя записанная в базу версия (None, если сессия не записывалась)."""
+
+    __slots__ = ("state", "data", "touched", "saved")
+
+    def __init__(self, state: int | None = None, data: dict | None = None, touched: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.touched = touched or time.time()
+        self.saved = None
+
+
+class MemorySessionStore:
+    """Сессии в памяти с вытеснением давно не использованных (LRU) и истечением по TTL."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _expired(self, session: Session) -> bool:
+        return time.time() - session.touched > self.ttl
+
+    def _remember(self, chat_id: int, session: Session):
+        self._sessions[chat_id] = session
+        self._sessions.move_to_end(chat_id)
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+
+    def _load(self, chat_id: int) -> Session | None:
+        return None
+
+    def get(self, chat_id: int) -> Session | None:
+        session = self._sessions.get(chat_id)
+        if session is None:
+            session = self._load(chat_id)
+            if session is None:
+                return None
+        if self._expired(session):
+            self.drop(chat_id)
+            return None
+        session.touched = time.time()
+        self._remember(chat_id, session)
+        return session
+
+    def ensure(self, chat_id: int) -> Session:
+        session = self.get(chat_id)
+        if session is None:
+            session = Session()
+            self._remember(chat_id, session)
+        return session
+
+    def drop(self, chat_id: int):
+        self._sessions.pop(chat_id, None)
+
+    def save(self, chat_id: int):
+        """Сохраняет сессию после обработки сообщения (в памяти ничего делать не нужно)."""
+
+    def close(self):
+        pass
+
+
+class SqliteSessionStore(MemorySessionStore):
+    """Сессии в памяти (горячий кэш) с записью изменённых сессий в локальную базу SQLite."""
+
+    def __init__(self, path: str, max_size: int, ttl: float):
+        super().__init__(max_size, ttl)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, state INTEGER, data TEXT, touched REAL)"
+        )
+        self._db.execute("DELETE FROM sessions WHERE touched < ?", (time.time() - ttl,))
+        self._db.commit()
+
+    def _load(self, chat_id: int) -> Session | None:
+        row = self._db.execute("SELECT state, data, touched FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        session = Session(row[0], json.loads(row[1]), row[2])
+        session.saved = (row[0], row[1])
+        return session
+
+    def drop(self, chat_id: int):
+        """Удаляет сессию из памяти и из базы; вытесненная из памяти сессия могла быть записана."""
+        session = self._sessions.get(chat_id)
+        super().drop(chat_id)
+        if session is None or session.saved is not None:
+            self._db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+            self._db.commit()
+
+    def save(self, chat_id: int):
+        """Записывает сессию, только если состояние или данные изменились."""
+        session = self._sessions.get(chat_id)
+        if session is None:
+            return
+        record = (session.state, json.dumps(session.data, ensure_ascii=False, separators=(",", ":")))
+        if session.saved == record:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (chat_id, state, data, touched) VALUES (?, ?, ?, ?)",
+                (chat_id, *record, session.touched)
+            )
+            self._db.commit()
+            session.saved = record
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logging.error(f"Error saving session {chat_id}: {e}")
+
+    def close(self):
+        self._db.close()
+
+
+class StateView:
+    """Словарь-представление состояний чатов поверх хранилища сессий."""
+
+    def __init__(self, store: MemorySessionStore, states):
+        self.store = store
+        self.states = states
+
+    def get(self, chat_id: int, default=None):
+        session = self.store.get(chat_id)
+        if session is None or session.state is None:
+            return default
+        return self.states(session.state)
+
+    def __getitem__(self, chat_id: int):
+        value = self.get(chat_id)
+        if value is None:
+            raise KeyError(chat_id)
+        return value
+
+    def __setitem__(self, chat_id: int, value):
+        self.store.ensure(chat_id).state = int(value)
+
+    def pop(self, chat_id: int, default=None):
+        value = self.get(chat_id, default)
+        self.store.drop(chat_id)
+        return value
+
+
+class DataView:
+    """Словарь-представление данных диалога чатов поверх хранилища сессий."""
+
+    def __init__(self, store: MemorySessionStore):
+        self.store = store
+
+    def get(self, chat_id: int, default=None):
+        session = self.store.get(chat_id)
+        return default if session is None else session.data
+
+    def __getitem__(self, chat_id: int) -> dict:
+        session = self.store.get(chat_id)
+        if session is None:
+            raise KeyError(chat_id)
+        return session.data
+
+    def __setitem__(self, chat_id: int, value: dict):
+        self.store.ensure(chat_id).data = value
+
+    def pop(self, chat_id: int, default=None):
+        value = self.get(chat_id, default)
+        self.store.drop(chat_id)
+        return value
+
+
+def create_session_store(backend: str, path: str, max_size: int, ttl: float) -> MemorySessionStore:
+    """Создаёт хранилище сессий: "memory" или "sqlite"."""
+    if backend == "sqlite":
+        return SqliteSessionStore(path, max_size, ttl)
+    return MemorySessionStore(max_size, ttl)
@@ -0,0 +1,92 @@
+import bisect
+from datetime import date, timedelta
+from config import GEMS, STATUS_PAGE_SIZE, EXPIRY_SOON_DAYS
+from ledger import Ledger, ledger, EDAN_ANALYZER
+from utils import parse_expiry
+
+SECTIONS = [f"GEM {gem}" for gem in GEMS] + ["Edan", "Getein"]
+# Фильтр /status -> разделы сводки
+FILTERS = {"all": SECTIONS, **{f"gem{gem}": [f"GEM {gem}"] for gem in GEMS}, "edan": ["Edan"], "getein": ["Getein"], "soon": SECTIONS}
+NO_EXPIRY = date.max.toordinal()
+
+
+def describe(sheet: str, key: tuple, qty: int) -> tuple[str, str, str]:
+    """Раздел, срок и строка отчёта для ключа журнала."""
+    if sheet == "stock":
+        gem, test, expiry = key
+        return f"GEM {gem}", expiry, f"{test} тестов, срок {expiry}: {qty} шт."
+    if sheet == "edan":
+        item, lot, expiry = key
+        if item == EDAN_ANALYZER:
+            return "Edan", "", f"{item}: {qty} шт."
+        return "Edan", expiry, f"{item}, лот {lot}, срок {expiry}: {qty} шт."
+    item, expiry = key
+    return "Getein", expiry, f"{item}, срок {expiry}: {qty} шт."
+
+
+class StockSummary:
+    """Материализованная сводка остатков для /status.
+
+    Строки отчёта хранятся по разделам в порядке срока годности и обновляются по одному ключу
+    при каждом изменении журнала, поэтому страница отчёта собирается срезом, без обхода всего склада.
+    """
+
+    def __init__(self, ledger: Ledger, page_size: int, soon_days: int):
+        self.page_size = page_size
+        self.soon_days = soon_days
+        self._keys = {section: [] for section in SECTIONS}  # раздел -> отсортированные (срок, лист, ключ)
+        self._lines = {section: [] for section in SECTIONS}  # раздел -> строки в том же порядке
+        for sheet in ("stock", "edan", "getein"):
+            for *key, qty in ledger.rows(sheet):
+                self.update(sheet, tuple(key), qty)
+        ledger.subscribe(self.update)
+
+    def update(self, sheet: str, key: tuple, qty: int):
+        """Вставляет, заменяет или удаляет строку одного ключа."""
+        section, expiry, line = describe(sheet, key, qty)
+        if section not in self._keys:
+            return
+        expiry_date = parse_expiry(expiry) if expiry else None
+        sort_key = (expiry_date.toordinal() if expiry_date else NO_EXPIRY, sheet, key)
+        keys, lines = self._keys[section], self._lines[section]
+        i = bisect.bisect_left(keys, sort_key)
+        found = i < len(keys) and keys[i] == sort_key
+        if qty <= 0:
+            if found:
+                del keys[i], lines[i]
+        elif found:
+            lines[i] = line
+        else:
+            keys.insert(i, sort_key)
+            lines.insert(i, line)
+
+    def _counts(self, filter_code: str) -> list[tuple[str, int]]:
+        """Разделы фильтра и число их строк; для "soon" — только сроки не позднее чем через soon_days дней."""
+        if filter_code != "soon":
+            return [(section, len(self._keys[section])) for section in FILTERS[filter_code]]
+        bound = ((date.today() + timedelta(days=self.soon_days)).toordinal() + 1,)
+        return [(section, bisect.bisect_left(self._keys[section], bound)) for section in FILTERS[filter_code]]
+
+    def page(self, filter_code: str, page: int) -> tuple[str, int, int]:
+        """Возвращает (текст страницы, номер страницы, число страниц)."""
+        if filter_code not in FILTERS:
+            filter_code = "all"
+        counts = self._counts(filter_code)
+        total = sum(count for _, count in counts)
+        pages = max(1, -(-total // self.page_size))
+        page = min(max(page, 0), pages - 1)
+        title = f"Истекают в ближайшие {self.soon_days} дн." if filter_code == "soon" else "Текущие остатки"
+        text = [f"{title} (стр. {page + 1}/{pages}):"]
+        start, stop, offset = page * self.page_size, (page + 1) * self.page_size, 0
+        for section, count in counts:
+            lo, hi = max(start - offset, 0), min(stop - offset, count)
+            if lo < hi:
+                text.append(f"\n{section}:")
+                text += [f"  - {line}" for line in self._lines[section][lo:hi]]
+            offset += count
+        if not total:
+            text.append("Склад пуст." if filter_code != "soon" else "Нет позиций с истекающим сроком.")
+        return "\n".join(text), page, pages
+
+
+stock_summary = StockSummary(ledger, STATUS_PAGE_SIZE, EXPIRY_SOON_DAYS)
@@ -1,24 +1,52 @@
+import functools
 import time
 import logging
 import re
-from PIL import Image
 import io
-import pytesseract
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING
+from config import GEMS, TESTS, OCR_MAX_SIDE, OCR_THRESHOLD, OCR_ROI, OCR_LANGS
+from metrics import handler_seconds
+
+if TYPE_CHECKING:
+    from PIL import Image
 
 
 def log_time(func):
-    """Логирует время выполнения функции."""
+    """Логирует время выполнения обработчика и добавляет его в гистограмму bot_handler_seconds.
+
+    functools.wraps сохраняет имя и сигнатуру: aiogram передаёт обработчику только объявленные аргументы.
+    """
 
+    @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = await func(*args, **kwargs)
-        elapsed = time.time() - start_time
-        logging.info(f"Handler {func.__name__} processed in {elapsed:.3f} seconds")
-        return result
+        start_time = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            handler_seconds.observe(elapsed, handler=func.__name__)
+            logging.info(f"Handler {func.__name__} processed in {elapsed:.3f} seconds")
 
     return wrapper
 
 
+def parse_expiry(expiry: str) -> date | None:
+    """Разбирает срок годности (дд.мм.гггг, мм.гггг, гггг-мм-дд, дд/мм/гггг); месяц без дня — его последний день."""
+    text = str(expiry).strip()
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    try:
+        month = datetime.strptime(text, "%m.%Y")
+    except ValueError:
+        return None
+    next_month = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return (next_month - timedelta(days=1)).date()
+
+
 def extract_gem_info(ocr_text: str) -> tuple[str | None, str | None, str | None]:
     """Извлекает информацию о GEM из OCR-текста."""
     # Улучшенные паттерны для распознавания
@@ -60,10 +88,67 @@ def extract_gem_info(ocr_text: str) -> tuple[str | None, str | None, str | None]
     return gem_value, expiry_value, tests_value
 
 
-async def process_image(image: bytes) -> str:
-    """Обрабатывает изображение и возвращает распознанный текст."""
+def otsu_threshold(histogram: list[int]) -> int:
+    """Подбирает порог бинаризации по гистограмме яркости (метод Оцу)."""
+    total = sum(histogram)
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    sum_bg = weight_bg = 0
+    best_variance, threshold = 0.0, 128
+    for i, count in enumerate(histogram):
+        weight_bg += count
+        if not weight_bg:
+            continue
+        weight_fg = total - weight_bg
+        if not weight_fg:
+            break
+        sum_bg += i * count
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if variance > best_variance:
+            best_variance, threshold = variance, i + 1
+    return threshold
+
+
+def preprocess_image(image: bytes, timings: dict) -> "Image.Image":
+    """Декодирует фото с уменьшением, обрезает до области этикетки и бинаризует по таблице."""
+    from PIL import Image  # Импорт только в процессах OCR, не при запуске бота
+    start = time.perf_counter()
     img = Image.open(io.BytesIO(image))
-    # Предобработка изображения для улучшения OCR
+    img.draft("L", (OCR_MAX_SIDE, OCR_MAX_SIDE))  # JPEG декодируется сразу в уменьшенном масштабе
     img = img.convert("L")  # Черно-белое изображение
-    img = img.point(lambda x: 0 if x < 128 else 255, "1")  # Бинаризация
-    return pytesseract.image_to_string(img, lang="eng+rus")
\ No newline at end of file
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if OCR_ROI:
+        width, height = img.size
+        left, top, right, bottom = OCR_ROI
+        img = img.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+    if max(img.size) > OCR_MAX_SIDE:
+        img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.Resampling.BILINEAR)
+    timings["resize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    threshold = otsu_threshold(img.histogram()) if OCR_THRESHOLD == "otsu" else 128
+    img = img.point([0] * threshold + [255] * (256 - threshold), "1")  # Бинаризация по таблице
+    timings["threshold"] = time.perf_counter() - start
+    return img
+
+
+def process_image(image: bytes, timeout: float = 0) -> tuple[str, dict]:
+    """Распознаёт текст на фото (в процессе пула OCR); возвращает текст и время этапов.
+
+    Языки из OCR_LANGS пробуются по очереди, пока extract_gem_info не найдёт модель, тесты и срок.
+    """
+    import pytesseract
+    timings = {}
+    img = preprocess_image(image, timings)
+    text = ""
+    for lang in OCR_LANGS:
+        start = time.perf_counter()
+        text = pytesseract.image_to_string(img, lang=lang, timeout=timeout)
+        timings[f"ocr_{lang}"] = time.perf_counter() - start
+        gem, expiry, tests = extract_gem_info(text)
+        if gem in GEMS and tests in TESTS and expiry:
+            break
+    return text, timings